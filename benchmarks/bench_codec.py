@@ -0,0 +1,82 @@
+"""
+Benchmark the binary wire format against JSON: encode and decode time and bytes per hop for a query whose route has
+5, 15 and 30 stations (the timetables of tests/networks/net12, repeated along the route).
+
+Usage: python benchmarks/bench_codec.py
+"""
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+import uuid
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+
+import station  # noqa: E402
+
+NETWORK = os.path.join(REPOSITORY, "tests", "networks", "net12")
+HOPS = [5, 15, 30]
+REPEATS = 5  # the best of the repeats is reported
+
+
+def getStations():
+    stations = []
+    with open(os.path.join(NETWORK, "adjacency")) as file:
+        names = [line.split()[0] for line in file]
+    for index, name in enumerate(names):
+        stationObject = station.Station(name, 4000 + 2 * index, 4001 + 2 * index)
+        with contextlib.redirect_stdout(io.StringIO()):
+            timetable, stationCoordinates = station.readTimetable(os.path.join(NETWORK, "tt-" + name))
+        stationObject.setTimetable(timetable)
+        stations.append(stationObject)
+    return stations
+
+
+def getMessage(stations, hops):
+    """
+    Get the message of a 06:00 query as it leaves the last station of a route with the given number of stations
+    """
+    message = station.Message(stations[0].stationName, "Nowhere", "FastestTrip", "06:00", uuid.uuid1().int,
+                              "outgoing", station.QUERY_TIMEOUT)
+    for index in range(hops):
+        message.addRoute(stations[index % len(stations)])
+    msg = dict(vars(message))
+    msg["hopCount"] = hops - 1
+    msg["capabilities"] = list(station.CAPABILITIES)
+    return msg
+
+
+def getMicroseconds(function, count):
+    best = None
+    for repeat in range(REPEATS):
+        started = time.perf_counter()
+        for index in range(count):
+            function()
+        elapsed = (time.perf_counter() - started) / count
+        best = elapsed if best == None else min(best, elapsed)
+    return best * 1e6
+
+
+def main():
+    stations = getStations()
+    print(f"{'hops':>4} | {'json bytes':>10} {'encode us':>9} {'decode us':>9} | "
+          f"{'binary bytes':>12} {'encode us':>9} {'decode us':>9}")
+    for hops in HOPS:
+        msg = getMessage(stations, hops)
+        jsonData = json.dumps(msg).encode(station.FORMAT)
+        binaryData = station.encodeBinaryMessage(msg)
+        assert station.decodeMessage(binaryData) == json.loads(jsonData)
+        count = 2000 // hops
+        print(f"{hops:>4} | {len(jsonData):>10} "
+              f"{getMicroseconds(lambda: json.dumps(msg).encode(station.FORMAT), count):>9.1f} "
+              f"{getMicroseconds(lambda: json.loads(jsonData.decode(station.FORMAT)), count):>9.1f} | "
+              f"{len(binaryData):>12} "
+              f"{getMicroseconds(lambda: station.encodeBinaryMessage(msg), count):>9.1f} "
+              f"{getMicroseconds(lambda: station.decodeBinaryMessage(binaryData), count):>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Micro-benchmark MessageSentLogs as the number of messages waiting for a reply grows, against the list it replaced.
+Each message is sent to 4 neighbours (the "already sent?" check sendUdp makes, then the log of each send) and then
+takes in their replies (removing each log and getting the logs still waiting). The time per message includes
+uuid.uuid1 for its messageId, and should stay flat for the indexed logs.
+
+Usage: python benchmarks/bench_sentlogs.py
+"""
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import station  # noqa: E402
+
+IN_FLIGHT = [100, 1000, 10000]  # messages already waiting for replies, 4 logs each
+PARENT = "http://127.0.0.1:6000"
+STATION = "http://127.0.0.1:6001"
+NEIGHBOURS = [f"http://127.0.0.1:{7000 + index}" for index in range(4)]
+
+
+class ListMessageSentLogs:
+    """
+    MessageSentLogs as it was before it was indexed: a list that every operation scans
+    """
+
+    def __init__(self):
+        self.logs = []
+
+    def addLog(self, log):
+        self.logs.append(log)
+
+    def hasLog(self, messageId, destinationStationAddress):
+        # the scan sendUdp made for each neighbour
+        sent = False
+        for log in self.logs:
+            if str(messageId) == str(log.messageId) and str(destinationStationAddress) == str(log.destinationStationAddress):
+                sent = True
+        return sent
+
+    def removeLog(self, parentAddress, destinationStationAddress, messageId):
+        for record in self.logs:
+            if str(record.parentAddress) == str(parentAddress) and str(record.destinationStationAddress) == str(destinationStationAddress) and str(record.messageId) == str(messageId):
+                self.logs.remove(record)
+                return record
+        return None
+
+    def getLogs(self, messageId):
+        foundLog = []
+        for record in self.logs:
+            if str(record.messageId) == str(messageId):
+                foundLog.append(record)
+        if len(foundLog) > 0:
+            return foundLog
+        else:
+            return None
+
+
+def sendAndAnswer(messageSentLogs):
+    messageId = uuid.uuid1().int
+    for neighbour in NEIGHBOURS:
+        if not messageSentLogs.hasLog(messageId, neighbour):
+            messageSentLogs.addLog(station.MessageSentLog(messageId, PARENT, STATION, neighbour))
+    for neighbour in NEIGHBOURS:
+        messageSentLogs.removeLog(PARENT, neighbour, messageId)
+        messageSentLogs.getLogs(messageId)
+
+
+def getMicroseconds(logsClass, inFlight):
+    messageSentLogs = logsClass()
+    for index in range(inFlight):
+        for neighbour in NEIGHBOURS:
+            messageSentLogs.addLog(station.MessageSentLog(uuid.uuid1().int, PARENT, STATION, neighbour))
+    # fewer messages for the slow cases, so the benchmark finishes in a minute
+    messages = 2000 if logsClass is station.MessageSentLogs or inFlight < 10000 else 200
+    started = time.perf_counter()
+    for index in range(messages):
+        sendAndAnswer(messageSentLogs)
+    return (time.perf_counter() - started) / messages * 1e6
+
+
+def main():
+    print("in flight " + "".join(f"{inFlight * len(NEIGHBOURS):>12,}" for inFlight in IN_FLIGHT))
+    for label, logsClass in [("list", ListMessageSentLogs), ("indexed", station.MessageSentLogs)]:
+        print(f"{label:<9} " + "".join(f"{getMicroseconds(logsClass, inFlight):>9.1f} us" for inFlight in IN_FLIGHT))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+import sys
+import os
+import csv
+import bisect
+import heapq
+from array import array
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# AUTHOR : Jonathan Neo
+
+# Connection Scan Algorithm (CSA) routing over the merged timetables of a network of stations.
+# Every timetable record is a connection from a station to a destination, and all of them are kept in one array sorted
+# by departure. Used by station.py for gossip routing, and from the command line as an oracle for the routes found by
+# flooding a query:
+#     python3 connectionscan.py <directory> <from> <to> [time] [--profile] [--flood]
+
+INFINITY = 1 << 30  # arrival at a stop that has not been reached
+
+
+def getMinutes(time):
+    """
+    Convert a "HH:MM" time into minutes since midnight
+    """
+    hours, minutes = str(time).split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+def getTime(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+class ConnectionScan:
+    """
+    All connections of a network, one per timetable record, stored column by column and sorted by departure (then
+    arrival). The columns are NumPy arrays if NumPy is installed, else arrays from the standard library.
+    Add the timetables of the stations with addTimetable, then build before answering queries.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.nameIds = {}
+        self.records = []  # (departure, arrival, fromId, toId, lineId, stopId) until the connections are built
+        self.scanRows = []
+
+    def __len__(self):
+        return len(self.scanRows)
+
+    def getNameId(self, name):
+        nameId = self.nameIds.get(name)
+        if nameId == None:
+            nameId = len(self.names)
+            self.names.append(name)
+            self.nameIds[name] = nameId
+        return nameId
+
+    def addTimetable(self, stationName, timetableRecords):
+        """
+        Add the "departure, line, stop, arrival, destination" records of a station's timetable
+        """
+        fromId = self.getNameId(stationName)
+        for timetableRecord in timetableRecords:
+            self.records.append((getMinutes(timetableRecord[0]), getMinutes(timetableRecord[3]), fromId,
+                                 self.getNameId(str(timetableRecord[4])),
+                                 self.getNameId(str(timetableRecord[1])),
+                                 self.getNameId(str(timetableRecord[2]))))
+
+    def build(self):
+        """
+        Sort the connections into columns, and index the connections from each station to each other station
+        """
+        if numpy != None and len(self.records) > 0:
+            table = numpy.array(self.records, dtype=numpy.int32)
+            table = table[numpy.lexsort((table[:, 1], table[:, 0]))]
+            columns = [table[:, column] for column in range(6)]
+        else:
+            self.records.sort()
+            columns = [array("i", column) for column in zip(*self.records)] or [
+                array("i") for column in range(6)]
+        self.departures, self.arrivals, self.fromIds, self.toIds, self.lineIds, self.stopIds = columns
+        self.records = []
+        # rows of the columns the scans read, as tuples are the fastest to iterate over in Python
+        self.scanRows = list(zip(self.departures.tolist(), self.arrivals.tolist(), self.fromIds.tolist(),
+                                 self.toIds.tolist()))
+        # fromId: {toId: ([departure, ...], [index, ...])} in the order of the connections
+        self.connectionsFrom = {}
+        for index, (departure, arrival, fromId, toId) in enumerate(self.scanRows):
+            departures, indexes = self.connectionsFrom.setdefault(fromId, {}).setdefault(toId, ([], []))
+            departures.append(departure)
+            indexes.append(index)
+
+    def findFirstConnection(self, minutes):
+        """
+        Find the index of the first connection departing at or after the given minute
+        """
+        if numpy != None and isinstance(self.departures, numpy.ndarray):
+            return int(numpy.searchsorted(self.departures, minutes, side="left"))
+        return bisect.bisect_left(self.departures, minutes)
+
+    def getRecord(self, index):
+        names = self.names
+        return [getTime(int(self.departures[index])),
+                names[self.lineIds[index]],
+                names[self.stopIds[index]],
+                getTime(int(self.arrivals[index])),
+                names[self.toIds[index]]]
+
+    def earliestArrival(self, sourceName, destinationName, time, floodRules=False):
+        """
+        Find the journey from the source departing at or after the given time that arrives at the destination earliest.
+        With floodRules, only the connections a flooded query follows are taken (see floodArrival).
+        Returns a list of (stationName, record) legs, or None if there is no journey.
+        """
+        source = self.nameIds.get(sourceName)
+        destination = self.nameIds.get(destinationName)
+        if source == None or destination == None:
+            return None
+        if floodRules:
+            indexes = self.floodArrival(source, destination, getMinutes(time))
+            if indexes == None:
+                return None
+            return [(self.names[self.scanRows[index][2]], self.getRecord(index)) for index in indexes]
+        arrivals = [INFINITY] * len(self.names)
+        inConnections = [None] * len(self.names)
+        arrivals[source] = getMinutes(time)
+        scanRows = self.scanRows
+        for index in range(self.findFirstConnection(arrivals[source]), len(scanRows)):
+            departure, arrival, fromId, toId = scanRows[index]
+            if departure >= arrivals[destination]:
+                break  # no later connection can arrive any earlier
+            if arrivals[fromId] > departure or arrival >= arrivals[toId]:
+                continue
+            arrivals[toId] = arrival
+            inConnections[toId] = index
+        if inConnections[destination] == None:
+            return None
+        journey = []
+        stop = destination
+        while stop != source:
+            index = inConnections[stop]
+            stop = int(self.fromIds[index])
+            journey.insert(0, (self.names[stop], self.getRecord(index)))
+        return journey
+
+    def floodArrival(self, source, destination, minutes):
+        """
+        Find the earliest arrival at the destination over the connections a flooded query follows: the first departure
+        from a station to each other station after it is reached, none onwards from a station that has a departure to
+        the destination, and none back to a station already on the journey. As the connections a station takes depend
+        on when it is reached (in a timetable where a later departure can arrive earlier, a later arrival may catch a
+        faster connection), each station keeps a set of labels like the pruning of flooded queries in station.py: an
+        arrival is dropped if one that came no later takes every connection it would take.
+        Arrivals are taken in order from a heap, so the first one at the destination is the earliest.
+        Returns the indexes of the connections of the journey, or None if there is none.
+        """
+        scanRows = self.scanRows
+        labels = {}  # stationId: [frozenset of the (toId, arrival) connections taken from it, ...]
+        heap = [(minutes, 0, source, None)]  # (arrival, order, stationId, (index of the connection in, previous))
+        order = 0
+        while len(heap) > 0:
+            reached, _, stationId, journey = heapq.heappop(heap)
+            if stationId == destination:
+                indexes = []
+                while journey != None:
+                    indexes.append(journey[0])
+                    journey = journey[1]
+                return indexes[::-1]
+            onward = []
+            for toId, (departures, indexes) in self.connectionsFrom.get(stationId, {}).items():
+                position = bisect.bisect_left(departures, reached)
+                if position < len(departures):
+                    if toId == destination:
+                        onward = [indexes[position]]
+                        break
+                    onward.append(indexes[position])
+            trips = frozenset((scanRows[index][3], scanRows[index][1]) for index in onward)
+            stationLabels = labels.setdefault(stationId, [])
+            if any(trips <= otherTrips for otherTrips in stationLabels):
+                continue  # an arrival no later takes every connection this one would
+            stationLabels.append(trips)
+            for index in onward:
+                toId = scanRows[index][3]
+                visited = toId == source
+                previous = journey
+                while previous != None and not visited:
+                    visited = scanRows[previous[0]][3] == toId
+                    previous = previous[1]
+                if not visited:
+                    order = order + 1
+                    heapq.heappush(heap, (scanRows[index][1], order, toId, (index, journey)))
+        return None
+
+    def profile(self, sourceName, destinationName):
+        """
+        Find the earliest arrival at the destination for every departure time from the source (a profile query).
+        Connections are scanned in reverse, keeping the Pareto set of (departure, arrival) pairs of each station.
+        Returns the [departure, arrival] times of the source's journeys that are not beaten by a later departure.
+        """
+        source = self.nameIds.get(sourceName)
+        destination = self.nameIds.get(destinationName)
+        if source == None or destination == None:
+            return []
+        # stationId: ([-departure, ...], [arrival, ...]), appended in decreasing order of departure
+        profiles = {}
+        for departure, arrival, fromId, toId in reversed(self.scanRows):
+            if fromId == destination:
+                continue
+            if toId == destination:
+                reached = arrival
+            else:
+                onward = profiles.get(toId)
+                if onward == None:
+                    continue
+                # the earliest journey onwards departing at or after the arrival
+                position = bisect.bisect_right(onward[0], -arrival) - 1
+                if position < 0:
+                    continue
+                reached = onward[1][position]
+            negatedDepartures, arrivals = profiles.setdefault(fromId, ([], []))
+            if len(arrivals) > 0 and arrivals[-1] <= reached:
+                continue  # a journey departing no earlier arrives no later
+            if len(negatedDepartures) > 0 and negatedDepartures[-1] == -departure:
+                arrivals[-1] = reached
+            else:
+                negatedDepartures.append(-departure)
+                arrivals.append(reached)
+        negatedDepartures, arrivals = profiles.get(source, ([], []))
+        return [[getTime(-negatedDeparture), getTime(arrival)]
+                for negatedDeparture, arrival in zip(reversed(negatedDepartures), reversed(arrivals))]
+
+
+def readTimetableRecords(filepath):
+    """
+    Read the station name and the timetable records from a tt-<station> file
+    """
+    timetableRecords = []
+    with open(filepath, 'r') as file:
+        reader = csv.reader(file, delimiter=',')
+        stationCoordinates = next(reader)
+        for row in reader:
+            if len(row) >= 5:
+                timetableRecords.append(row)
+    return stationCoordinates[0], timetableRecords
+
+
+def loadNetwork(directory):
+    """
+    Build the connections of every tt-<station> file in the directory
+    """
+    connectionScan = ConnectionScan()
+    for filename in sorted(os.listdir(directory)):
+        if filename.startswith("tt-"):
+            stationName, timetableRecords = readTimetableRecords(
+                os.path.join(directory, filename))
+            connectionScan.addTimetable(stationName, timetableRecords)
+    connectionScan.build()
+    return connectionScan
+
+
+def main(argv):
+    inputs = [arg for arg in argv if not arg.startswith("--")]
+    if len(inputs) < 3:
+        print("Usage: python3 connectionscan.py <directory> <from> <to> [time] [--profile] [--flood]")
+        sys.exit(2)
+    directory, sourceName, destinationName = inputs[:3]
+    time = inputs[3] if len(inputs) > 3 else "00:00"
+    connectionScan = loadNetwork(directory)
+    print(
+        f"{len(connectionScan)} connections between {len(connectionScan.names)} names")
+    if "--profile" in argv:
+        for departure, arrival in connectionScan.profile(sourceName, destinationName):
+            print(f"{departure} -> {arrival}")
+        return None
+    journey = connectionScan.earliestArrival(
+        sourceName, destinationName, time, "--flood" in argv)
+    if journey == None:
+        print("No route found!")
+        return None
+    for stationName, record in journey:
+        print(f"{stationName}: {','.join(record)}")
+    return None
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
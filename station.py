@@ -1,5 +1,6 @@
 import socket
 import selectors
+import asyncio
 import types
 import os
 import sys
@@ -7,18 +8,96 @@ import csv
 import pathlib
 import json
 import time as ts
-import urllib
+import urllib.parse
 from datetime import datetime
 import copy
 import uuid
+import hashlib
+import gzip
+import html
+import bisect
+import heapq
+import itertools
+import operator
+import threading
+import queue
+import struct
+import ctypes
+import ctypes.util
+from array import array
+from collections import Counter, OrderedDict, deque
+import connectionscan
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # AUTHOR : Jonathan Neo
 
 # CONSTANTS
 SERVER = "127.0.0.1"
 FORMAT = "UTF-8"
-TRIP_TYPE = ["FastestTrip"]
-MESSAGE_SIZE = 50000
+TRIP_TYPE = ["FastestTrip", "LeastTransfers", "ParetoTrip"]
+MESSAGE_SIZE = 65507  # largest UDP payload over IPv4 that can be sent. Longer messages to Python stations are fragmented
+RECV_SIZE = 65535  # buffer for receiving a datagram
+ENGINES = ["selectors", "asyncio"]
+# capabilities a Python station advertises in the "capabilities" field of its JSON messages. Station.java drops the
+# field, so Java peers are never sent anything but plain JSON
+CAPABILITIES = ["reliable", "binary", "batch"]
+# envelope of datagrams between Python stations: magic, version, kind, boot id, sequence number. JSON datagrams start
+# with "{". The boot id is drawn at startup, so a peer can tell a restarted station's sequence numbers from the old ones
+ENVELOPE = struct.Struct("!2sBBII")
+ENVELOPE_MAGIC = b"ST"
+ENVELOPE_VERSION = 2
+KIND_DATA = 0
+KIND_ACK = 1
+KIND_FRAGMENT = 2
+KIND_BATCH = 3  # several messages, each preceded by its 2-byte length
+# header of a fragment after the envelope: message sequence number, fragment index, fragment count
+FRAGMENT = struct.Struct("!IHH")
+FRAGMENT_SIZE = 8192  # bytes of message per fragment
+BATCH_SIZE = FRAGMENT_SIZE  # bytes of messages batched into one datagram with --batch
+SEND_WINDOW = 8  # unacknowledged datagrams in flight to a peer, more are queued so bursts of fragments do not overflow its buffer
+REASSEMBLY_BUDGET = 16 * 1024 * 1024  # bytes of partly received messages kept before the oldest are dropped
+REASSEMBLY_TIMEOUT = 30  # seconds before a partly received message is dropped
+# compact binary message format between Python stations: magic, version, flags, hopCount
+BINARY_HEADER = struct.Struct("!2sBBH")
+BINARY_MAGIC = b"SB"
+BINARY_VERSION = 1
+BINARY_INCOMING = 1
+BINARY_ROUTE_END_FOUND = 2
+BINARY_QUERY_TIMEOUT = 4
+BINARY_TIMETABLE_VERSIONS = 8  # each stop's timetableVersion follows the messageIds. Older stations ignore it
+BINARY_INCOMPLETE = 16  # the message's incomplete depth follows the timetable versions
+BINARY_FIELDS = {"sourceName", "destinationName", "route", "tripType", "hopCount", "time", "messageId",
+                 "messageType", "routeEndFound", "queryTimeout", "capabilities", "incomplete"}
+BINARY_STOP_FIELDS = {"stationName", "messageId",
+                      "stationUDPAddress", "earliestTrips", "timetableVersion"}
+RETRANSMIT_TIMEOUT = 0.2  # seconds before the first retransmission, doubled for each retry
+RETRANSMIT_ATTEMPTS = 5  # retransmissions before a datagram is given up on
+DUPLICATE_WINDOW = 1024  # sequence numbers remembered per peer to suppress duplicates
+QUERY_TIMEOUT = 10  # seconds the source station waits for replies before answering with the best route found so far
+HOP_TIMEOUT_MARGIN = 0.1  # seconds less each hop waits than its parent, so its reply can get back in time
+MIN_HOP_TIMEOUT = 0.5  # seconds even the deepest hops wait for replies
+CLIENT_TIMEOUT = 60  # seconds a browser waits on the asyncio engine before it is told no route was found
+TCP_RECV_SIZE = 4096  # bytes read from a client connection at a time
+MAX_HEADER_SIZE = 8192  # bytes of request line and headers before a request is rejected
+MAX_BODY_SIZE = 65536  # bytes of request body before a request is rejected with 413 Payload Too Large
+# bytes a client may send ahead of the answer to its last request before the connection is closed
+MAX_BUFFER_SIZE = 2 * (MAX_HEADER_SIZE + MAX_BODY_SIZE)
+KEEP_ALIVE_TIMEOUT = 15  # seconds an idle keep-alive connection is kept open for its next request
+GZIP_MIN_SIZE = 256  # bytes of JSON below which a response is not worth compressing
+MAX_BATCH_QUERIES = 100  # queries in one /api/routes request
+TIMETABLE_POLL_INTERVAL = 1  # seconds between os.stat checks when inotify is not available
+ROUTING = ["flood", "gossip"]
+GOSSIP_INTERVAL = 30  # seconds between the timetable summaries a station floods in gossip routing
+GOSSIP_MAX_AGE = 4 * GOSSIP_INTERVAL  # seconds before the summary of a station that has gone quiet is dropped
+ROUTE_CACHE_SIZE = 256  # answers the source station keeps for repeated queries
+ROUTE_CACHE_BUCKET = 15  # minutes of departure time that share a route cache entry
+ROUTE_CACHE_TTL = 300  # seconds a cached answer is used for, as changes at stations off its route are not seen
+# "HH:MM" strings for every minute of two days so timetable records can be rebuilt without formatting
+TIME_STRINGS = [f"{minutes // 60:02d}:{minutes % 60:02d}"
+                for minutes in range(2 * 24 * 60)]
 
 
 class Station:
@@ -28,7 +107,7 @@ class Station:
 
     def __init__(self, station, tcp_port, udp_port):
         self.stationName = station
-        self.MessageSize = MESSAGE_SIZE
+        self.MessageSize = RECV_SIZE
         if tcp_port == None:
             self.tcp_port = 0
         else:
@@ -42,16 +121,57 @@ class Station:
         self.udp_address = (self.server, self.udp_port)
         self.format = FORMAT
         self.neighbours = []
+        self.neighboursByAddress = {}  # stationUDPAddress: neighbour
+        self.timetableVersion = 0
+        # the start time tells apart the timetable versions of this station from before and after it restarts
+        self.epoch = int(ts.time() * 1000)
+        self.timetableListeners = []
+        self.queryTimeout = QUERY_TIMEOUT
+        self.prune = True  # prune branches whose onward trips another branch of the query already takes
+        self.arrivalLabels = ArrivalLabels()
+        self.capabilities = list(CAPABILITIES)
+        self.udpBufferSize = None  # SO_RCVBUF and SO_SNDBUF of the UDP socket, None keeps the OS default
+        self.batchWindow = None  # seconds messages to a peer wait to be batched into one datagram, None sends them at once
+        self.batchSize = BATCH_SIZE
+        # call_later(delay, callback, *args) scheduler: a TimerHeap (selectors engine) or the asyncio event loop
+        self.timers = None
+        self.topology = None  # TopologyDatabase of the gossiped timetable summaries, None unless --routing=gossip
+        self.routeCache = RouteCache(self)
+        self.subRouteCache = SubRouteCache(
+            self, timetableVersions=self.routeCache.timetableVersions)
+        self.addTimetableListener(self.routeCache.clear)
+        self.addTimetableListener(self.subRouteCache.clear)
+        self.page = HtmlPage(self)
+        self.addTimetableListener(self.page.clear)
 
     def setCoordinates(self, x, y):
         self.x = x
         self.y = y
 
-    def setTimetable(self, timetable):
+    def setTimetable(self, timetable, changedDestinations=None):
+        """
+        Set the timetable and let the timetable listeners know which destinations changed (None means all of them)
+        """
         self.timetable = timetable
+        self.timetableVersion = self.timetableVersion + 1
+        for listener in self.timetableListeners:
+            listener(changedDestinations)
+
+    def addTimetableListener(self, listener):
+        self.timetableListeners.append(listener)
 
     def addNeighbour(self, neighbour):
         self.neighbours.append(neighbour)
+        self.neighboursByAddress[neighbour.getStationUDPAddress()] = neighbour
+
+    def learnNeighbourNames(self, route):
+        """
+        Name the neighbours that appear in the route of a message. Neighbours are only given by their UDP port
+        """
+        for stop in route:
+            neighbour = self.neighboursByAddress.get(stop["stationUDPAddress"])
+            if neighbour != None and neighbour.stationName != stop["stationName"]:
+                neighbour.stationName = stop["stationName"]
 
     def getStationUDPAddress(self):
         return f"http://{self.server}:{self.udp_port}"
@@ -60,72 +180,860 @@ class Station:
         return f"http://{self.server}:{self.tcp_port}"
 
     def getEarliestTrips(self, time):
-        earliestTrips = []
-        for timetableRecord in self.timetable:
-            timeValue = datetime.strptime(time, "%H:%M")
-            timetableRecordTime = datetime.strptime(
-                timetableRecord[0], "%H:%M")
-            timetableRecordDestination = str(timetableRecord[4])
-            if len(earliestTrips) == 0:
-                if timetableRecordTime >= timeValue:
-                    earliestTrips.append(
-                        timetableRecord)
-            else:
-                recordFound = False
-                for trips in earliestTrips:
-                    if timetableRecordTime >= timeValue and str(trips[4]) == str(timetableRecordDestination):
-                        recordFound = True
-                if recordFound == False:
-                    earliestTrips.append(
-                        timetableRecord)
-        return earliestTrips
+        """
+        Get the earliest trip to each destination departing at or after the given time
+        """
+        return self.timetable.getEarliestTrips(time)
+
+    def getTimetableStamp(self):
+        """
+        Get the version of the timetable this station sends with its stop in a route, e.g. "1603000000000.2"
+        """
+        return f"{self.epoch}.{self.timetableVersion}"
 
     def getStationObject(self, messageId, time):
         return {
             "stationName": self.stationName,
             "messageId": messageId,
             "stationUDPAddress": self.getStationUDPAddress(),
-            "earliestTrips": self.getEarliestTrips(time)
+            "earliestTrips": self.getEarliestTrips(time),
+            "timetableVersion": self.getTimetableStamp()
+        }
+
+
+def getMinutes(time):
+    """
+    Convert a "HH:MM" time string into minutes since midnight
+    """
+    hour, minute = str(time).split(":")
+    return int(hour) * 60 + int(minute)
+
+
+def getTime(minutes):
+    """
+    Convert minutes since midnight back into a "HH:MM" time string
+    """
+    if minutes < len(TIME_STRINGS):
+        return TIME_STRINGS[minutes]
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+class TimetableBucket:
+    """
+    All timetable records to a single destination, stored column by column and sorted by departure minute.
+    Times are minutes since midnight and names are ids into the owning Timetable's name table.
+    """
+
+    def __init__(self, destinationId, rows):
+        rows = sorted(rows, key=lambda row: row[0])
+        self.destinationId = destinationId
+        self.departures = array("H", [row[0] for row in rows])
+        self.lineIds = array("I", [row[1] for row in rows])
+        self.stopIds = array("I", [row[2] for row in rows])
+        self.arrivals = array("H", [row[3] for row in rows])
+
+    def __len__(self):
+        return len(self.departures)
+
+    def getRows(self):
+        """
+        Get the (departure, lineId, stopId, arrival) rows in departure order
+        """
+        return list(zip(self.departures, self.lineIds, self.stopIds, self.arrivals))
+
+    def getDepartures(self):
+        """
+        Iterate over (departure, destinationId, position) in departure order
+        """
+        for position, departure in enumerate(self.departures):
+            yield departure, self.destinationId, position
+
+    def findDeparture(self, minutes):
+        """
+        Find the position of the first departure at or after the given minute, or None if there is none
+        """
+        position = bisect.bisect_left(self.departures, minutes)
+        if position < len(self.departures):
+            return position
+        return None
+
+
+class Timetable:
+    """
+    Compact columnar store of a station timetable (tt-<station>).
+    Records are grouped by destination into TimetableBuckets and line, stop and destination names
+    are interned into integer ids, so no per-row lists are kept in memory.
+    """
+
+    def __init__(self, names=None, nameIds=None):
+        # the name table is only ever appended to, so it can be shared by later versions of the timetable
+        self.names = names if names != None else []
+        self.nameIds = nameIds if nameIds != None else {}
+        self.buckets = {}
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets.values())
+
+    def __iter__(self):
+        """
+        Iterate over the timetable records in departure order
+        """
+        departures = [bucket.getDepartures() for bucket in self.buckets.values()]
+        for departure, destinationId, position in heapq.merge(*departures):
+            yield self.getRecord(self.buckets[destinationId], position)
+
+    def getNameId(self, name):
+        nameId = self.nameIds.get(name)
+        if nameId == None:
+            nameId = len(self.names)
+            self.names.append(name)
+            self.nameIds[name] = nameId
+        return nameId
+
+    def getRowsByDestination(self, timetableRecords):
+        """
+        Group "departure, line, stop, arrival, destination" records into (departure, lineId, stopId, arrival) rows per destination id
+        """
+        rowsByDestination = {}
+        for timetableRecord in timetableRecords:
+            destinationId = self.getNameId(str(timetableRecord[4]))
+            if destinationId not in rowsByDestination:
+                rowsByDestination[destinationId] = []
+            rowsByDestination[destinationId].append((getMinutes(timetableRecord[0]),
+                                                     self.getNameId(
+                                                         str(timetableRecord[1])),
+                                                     self.getNameId(
+                                                         str(timetableRecord[2])),
+                                                     getMinutes(timetableRecord[3])))
+        return rowsByDestination
+
+    def addRecords(self, timetableRecords):
+        """
+        Add "departure, line, stop, arrival, destination" records and sort each destination by departure
+        """
+        for destinationId, rows in self.getRowsByDestination(timetableRecords).items():
+            self.buckets[destinationId] = TimetableBucket(destinationId, rows)
+
+    def patch(self, timetableRecords):
+        """
+        Build the next version of this timetable from freshly read records.
+        Only destinations whose rows changed get a new bucket, the others share their bucket with this timetable.
+        Returns the new timetable and the names of the changed destinations.
+        """
+        timetable = Timetable(self.names, self.nameIds)
+        changedDestinations = set()
+        rowsByDestination = timetable.getRowsByDestination(timetableRecords)
+        for destinationId, rows in rowsByDestination.items():
+            bucket = self.buckets.get(destinationId)
+            rows = sorted(rows, key=lambda row: row[0])
+            if bucket != None and bucket.getRows() == rows:
+                timetable.buckets[destinationId] = bucket
+                continue
+            oldRows = Counter(bucket.getRows()) if bucket != None else Counter()
+            newRows = Counter(rows)
+            print(f"Timetable to {self.names[destinationId]} changed: {sum((newRows - oldRows).values())} rows added, "
+                  f"{sum((oldRows - newRows).values())} rows removed")
+            timetable.buckets[destinationId] = TimetableBucket(
+                destinationId, rows)
+            changedDestinations.add(self.names[destinationId])
+        for destinationId in self.buckets:
+            if destinationId not in rowsByDestination:
+                print(
+                    f"Timetable to {self.names[destinationId]} changed: all rows removed")
+                changedDestinations.add(self.names[destinationId])
+        return timetable, changedDestinations
+
+    def getDepartureWindow(self, minutes):
+        """
+        Get the (first, last) minute that has the same earliest trip to each destination as the given minute: from just
+        after the last departure before it up to the first departure at or after it
+        """
+        first = 0
+        last = len(TIME_STRINGS) - 1
+        for bucket in self.buckets.values():
+            position = bisect.bisect_left(bucket.departures, minutes)
+            if position > 0:
+                first = max(first, bucket.departures[position - 1] + 1)
+            if position < len(bucket):
+                last = min(last, bucket.departures[position])
+        return first, last
+
+    def getRecord(self, bucket, position):
+        """
+        Build the timetable record at a position of a bucket as a list of strings
+        """
+        names = self.names
+        return [getTime(bucket.departures[position]),
+                names[bucket.lineIds[position]],
+                names[bucket.stopIds[position]],
+                getTime(bucket.arrivals[position]),
+                names[bucket.destinationId]]
+
+    def getRecords(self):
+        return list(self)
+
+    def getEarliestTrip(self, time, destinationName):
+        """
+        Get the earliest trip to the destination departing at or after the given time, or None
+        """
+        bucket = self.buckets.get(self.nameIds.get(destinationName))
+        if bucket == None:
+            return None
+        position = bucket.findDeparture(getMinutes(time))
+        if position == None:
+            return None
+        return self.getRecord(bucket, position)
+
+    def getEarliestTrips(self, time):
+        """
+        Get the earliest trip to each destination departing at or after the given time
+        """
+        earliestTrips = []
+        timeValue = getMinutes(time)
+        for bucket in self.buckets.values():
+            position = bucket.findDeparture(timeValue)
+            if position != None:
+                earliestTrips.append(self.getRecord(bucket, position))
+        return earliestTrips
+
+
+class ArrivalLabels:
+    """
+    The arrivals at this station seen so far for each query, kept for the lifetime of the query. Each label is an
+    arrival (in minutes) with the onward trips it leads to (see getOnwardTrips) and, for the trip types other than
+    FastestTrip, its transfers and line. Each label also keeps the route (station names) of the branch that set it.
+    """
+
+    def __init__(self):
+        self.labels = OrderedDict()  # str(query messageId): [list of labels, expiry], oldest first
+
+    def __len__(self):
+        return len(self.labels)
+
+    def expire(self):
+        """
+        Drop the labels of queries that have finished
+        """
+        now = ts.monotonic()
+        while len(self.labels) > 0 and next(iter(self.labels.values()))[1] <= now:
+            self.labels.popitem(last=False)
+        return now
+
+    def recordNonDominated(self, queryId, label, onwardTrips, lifetime, route):
+        """
+        Add an (arrival, transfers, line) label to the set of the query, unless a label in the set dominates it: arrives
+        no later with no more transfers, counting one more if it arrived on another line (as the new label could stay
+        on its line without a transfer), and leads to all of its onward trips. A FastestTrip label is (arrival, 0, None).
+        Returns None if it was added, else the route of the branch that set the dominating label
+        """
+        now = self.expire()
+        labels = self.labels.get(str(queryId))
+        if labels == None:
+            self.labels[str(queryId)] = [
+                [label + (onwardTrips, route)], now + lifetime]
+            return None
+        arrival, transfers, line = label
+        for otherArrival, otherTransfers, otherLine, otherTrips, otherRoute in labels[0]:
+            if otherArrival <= arrival and otherTransfers + (otherLine != line) <= transfers and \
+                    onwardTrips <= otherTrips:
+                return otherRoute
+        labels[0] = [other for other in labels[0]
+                     if not (arrival <= other[0] and transfers + (line != other[2]) <= other[1] and
+                             other[3] <= onwardTrips)]
+        labels[0].append(label + (onwardTrips, route))
+        return None
+
+
+class RouteCacheEntry:
+    """
+    An answer in the RouteCache
+    """
+
+    def __init__(self, message, departureWindow, earliestTrips, timetableVersions, visited):
+        self.message = message
+        self.departureWindow = departureWindow  # (first, last) minute of departure the answer holds for
+        # destinationName: the earliest trip to it from this station throughout the departure window
+        self.earliestTrips = earliestTrips
+        # stationName: timetableVersion of the stations on the routes (None for Java stations)
+        self.timetableVersions = timetableVersions
+        self.visited = visited  # names of the stations the query had visited before this one
+        self.stations = frozenset(timetableVersions)  # names of the stations on the routes
+        self.expiry = ts.monotonic() + ROUTE_CACHE_TTL
+
+
+class RouteCache:
+    """
+    LRU cache of the answers to the queries this station was the source of, keyed by
+    (destination, departure minute bucket, tripType). An answer is only used for departure times with the same earliest
+    trips from this station, and while the stations on its route have not sent a newer timetableVersion in a reply.
+    When this station's timetable changes, only the answers whose earliest trip to a changed destination is no longer
+    the same are dropped.
+    """
+
+    def __init__(self, station, size=ROUTE_CACHE_SIZE, timetableVersions=None):
+        self.station = station
+        self.size = size
+        self.entries = OrderedDict()  # key: RouteCacheEntry, least recently used first
+        # stationName: latest timetableVersion seen in a route
+        self.timetableVersions = timetableVersions if timetableVersions != None else {}
+        self.counters = Counter(hits=0, misses=0, stale=0)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def getKey(self, msg, departure):
+        return (msg["destinationName"], departure // ROUTE_CACHE_BUCKET, msg["tripType"])
+
+    def clear(self, changedDestinations=None):
+        """
+        The timetable of this station has changed. Drop the answers that may depend on the changed destinations (all
+        of them if None): those whose departure window now has another earliest trip to one of them, so a flood would
+        now take another trip. The other answers still hold, and are stamped with the new timetable version
+        """
+        if changedDestinations == None:
+            self.entries.clear()
+            return
+        stationName = self.station.stationName
+        timetableStamp = self.station.getTimetableStamp()
+        for key, entry in list(self.entries.items()):
+            first = getTime(entry.departureWindow[0])
+            if any(self.station.timetable.getEarliestTrip(first, destinationName) != entry.earliestTrips.get(destinationName)
+                   for destinationName in changedDestinations):
+                del self.entries[key]
+                continue
+            entry.timetableVersions[stationName] = timetableStamp
+            for route in [entry.message["route"]] + entry.message.get("paretoRoutes", []):
+                for stop in route:
+                    if stop["stationName"] == stationName:
+                        stop["timetableVersion"] = timetableStamp
+
+    def learnVersions(self, route):
+        """
+        Remember the timetableVersion of each station in the route of a message. This station's own version is
+        always its current one (a late reply may carry the version from before a reload)
+        """
+        for stop in route:
+            timetableVersion = stop.get("timetableVersion")
+            if timetableVersion != None and stop["stationName"] != self.station.stationName:
+                self.timetableVersions[stop["stationName"]] = timetableVersion
+
+    def isStale(self, entry):
+        if entry.expiry <= ts.monotonic():
+            return True
+        for stationName, timetableVersion in entry.timetableVersions.items():
+            latestVersion = self.timetableVersions.get(stationName, timetableVersion)
+            if stationName == self.station.stationName:
+                latestVersion = self.station.getTimetableStamp()
+            if timetableVersion != None and latestVersion != timetableVersion:
+                return True
+        return False
+
+    def store(self, key, message, routes, departure, visited=frozenset()):
+        """
+        Cache a copy of the message, whose routes start at this station and leave it at the given minute
+        """
+        if self.size <= 0:
+            return
+        timetableVersions = {}
+        for route in routes:
+            for stop in route:
+                timetableVersions[stop["stationName"]] = stop.get(
+                    "timetableVersion")
+        if timetableVersions.get(self.station.stationName) != self.station.getTimetableStamp():
+            return  # this station's timetable changed while the query was out
+        departureWindow = self.station.timetable.getDepartureWindow(departure)
+        earliestTrips = {trip[4]: trip for trip in
+                         self.station.timetable.getEarliestTrips(getTime(departureWindow[0]))}
+        self.entries[key] = RouteCacheEntry(copy.deepcopy(message), departureWindow, earliestTrips,
+                                            timetableVersions, visited)
+
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def lookup(self, key, departure, visited=frozenset()):
+        """
+        Get the cached entry for a query leaving this station at the given minute, having visited the given stations.
+        The stations the cached query had visited must all have been visited (so no route it could not take is now
+        open) and none of the stations on its routes
+        """
+        entry = self.entries.get(key)
+        if (entry == None or not entry.departureWindow[0] <= departure <= entry.departureWindow[1]
+                or not entry.visited <= visited or not visited.isdisjoint(entry.stations)):
+            self.counters["misses"] += 1
+            return None
+        if self.isStale(entry):
+            del self.entries[key]
+            self.counters["stale"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.counters["hits"] += 1
+        return entry
+
+    def add(self, msg):
+        """
+        Cache the collated answer to a query from this station
+        """
+        departure = getMinutes(msg["time"])
+        self.store(self.getKey(msg, departure), msg,
+                   [msg["route"]] + msg.get("paretoRoutes", []), departure)
+
+    def get(self, msg):
+        """
+        Get a copy of the cached answer to the query, or None
+        """
+        departure = getMinutes(msg["time"])
+        entry = self.lookup(self.getKey(msg, departure), departure)
+        if entry == None:
+            return None
+        return dict(copy.deepcopy(entry.message), messageId=msg["messageId"], time=msg["time"])
+
+
+class SubRouteCache(RouteCache):
+    """
+    LRU cache of the best onward routes this station collated for the queries that passed through it, keyed like the
+    RouteCache by the arrival at this station. Only complete answers are cached (see isCompleteAt): an answer that
+    missed a reply, or that a branch of was pruned in favour of another branch of the same query, may not be the best
+    one for another query.
+    """
+
+    def getArrival(self, msg):
+        """
+        Get the arrival (in minutes) at this station of a message whose route[hopCount] is this station
+        """
+        for trip in msg["route"][msg["hopCount"] - 1]["earliestTrips"]:
+            if trip[4] == self.station.stationName:
+                return getMinutes(trip[3])
+
+    def getVisited(self, msg):
+        return frozenset(stop["stationName"] for stop in msg["route"][:msg["hopCount"]])
+
+    def add(self, msg):
+        """
+        Cache the onward routes of a collated message whose route[hopCount] is this station
+        """
+        hopCount = msg["hopCount"]
+        if not isCompleteAt(msg, hopCount):
+            return
+        onward = {"routeEndFound": msg["routeEndFound"],
+                  "route": msg["route"][hopCount:]}
+        if "paretoRoutes" in msg:
+            onward["paretoRoutes"] = [route[hopCount:]
+                                      for route in msg["paretoRoutes"]]
+        arrival = self.getArrival(msg)
+        self.store(self.getKey(msg, arrival), onward, [onward["route"]] + onward.get("paretoRoutes", []),
+                   arrival, self.getVisited(msg))
+
+    def get(self, msg):
+        """
+        Get the message with the cached onward routes from this station (route[hopCount]) filled in, or None
+        """
+        arrival = self.getArrival(msg)
+        entry = self.lookup(self.getKey(msg, arrival),
+                            arrival, self.getVisited(msg))
+        if entry == None:
+            return None
+        hopCount = msg["hopCount"]
+        onward = copy.deepcopy(entry.message)
+        msg["routeEndFound"] = onward["routeEndFound"]
+        msg["route"] = msg["route"][:hopCount] + onward["route"]
+        msg.pop("paretoRoutes", None)
+        if "paretoRoutes" in onward:
+            msg["paretoRoutes"] = [msg["route"][:hopCount] +
+                                   route for route in onward["paretoRoutes"]]
+        return msg
+
+
+class TopologyEntry:
+    """
+    The latest timetable summary of one station in the TopologyDatabase
+    """
+
+    def __init__(self, stationName, stationUDPAddress, version, neighbours, timetable):
+        self.stationName = stationName
+        self.stationUDPAddress = stationUDPAddress
+        self.version = version  # [epoch, sequence number]
+        self.neighbours = neighbours  # UDP addresses of the station's neighbours
+        self.timetable = timetable
+        self.neighbourNames = []  # names of the neighbours, filled in by TopologyDatabase.getNetwork
+        self.receivedAt = ts.monotonic()
+
+
+class TopologyDatabase:
+    """
+    Link-state database for gossip routing. Each station floods a summary of its timetable (per destination, the
+    departure-sorted departures, arrivals, lines and stops) with the addresses of its neighbours and a version.
+    The summaries are kept as Timetables keyed by UDP address, so a query can be answered locally with the same
+    earliest trip per destination that the stations use when a query is flooded.
+    """
+
+    def __init__(self, station):
+        self.station = station
+        self.sequence = 0
+        self.entries = {}  # stationUDPAddress: TopologyEntry of the other stations
+        # one name table for the timetables of all the other stations
+        self.names = []
+        self.nameIds = {}
+        self.changes = 0  # number of times a station's timetable or neighbours have changed
+        # ConnectionScan of the network and the (changes, timetableVersion) it was built for
+        self.connectionScan = None
+        self.connectionScanVersion = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def getVersion(self):
+        return [self.station.epoch, self.sequence]
+
+    def encodeBuckets(self, timetable, destinationNames=None):
+        """
+        Summarise the timetable to each destination as [departures, arrivals, lines, stops] columns.
+        destinationNames limits the summary to some destinations, those with no trips get empty columns.
+        """
+        names = timetable.names
+        if destinationNames == None:
+            destinationNames = [names[destinationId]
+                                for destinationId in timetable.buckets]
+        summary = {}
+        for destinationName in destinationNames:
+            bucket = timetable.buckets.get(
+                timetable.nameIds.get(destinationName))
+            if bucket == None:
+                summary[destinationName] = [[], [], [], []]
+                continue
+            summary[destinationName] = [bucket.departures.tolist(),
+                                        bucket.arrivals.tolist(),
+                                        [names[lineId]
+                                            for lineId in bucket.lineIds],
+                                        [names[stopId] for stopId in bucket.stopIds]]
+        return summary
+
+    def getSummary(self, entry):
+        return {
+            "stationName": entry.stationName,
+            "stationUDPAddress": entry.stationUDPAddress,
+            "version": entry.version,
+            "neighbours": entry.neighbours,
+            "timetable": self.encodeBuckets(entry.timetable)
+        }
+
+    def getStationSummary(self, destinationNames=None):
+        """
+        Summarise this station's timetable under the current version
+        """
+        station = self.station
+        return {
+            "stationName": station.stationName,
+            "stationUDPAddress": station.getStationUDPAddress(),
+            "version": self.getVersion(),
+            "neighbours": [neighbour.getStationUDPAddress() for neighbour in station.neighbours],
+            "timetable": self.encodeBuckets(station.timetable, destinationNames)
         }
 
+    def originate(self, changedDestinations=None):
+        """
+        Summarise this station's timetable under a new version. If only some destinations changed, the summary only
+        holds those and the version it applies to (baseVersion), so a change costs a few rows instead of the timetable.
+        """
+        baseVersion = self.getVersion()
+        self.sequence = self.sequence + 1
+        summary = self.getStationSummary(changedDestinations)
+        if changedDestinations != None:
+            summary["baseVersion"] = baseVersion
+        return summary
+
+    def getSummaries(self):
+        """
+        Get full summaries of this station and every station in the database, e.g. for a neighbour that has just started
+        """
+        summaries = [self.getStationSummary()]
+        for entry in self.getEntries():
+            summaries.append(self.getSummary(entry))
+        return summaries
+
+    def addSummary(self, summary):
+        """
+        Store a summary if it is newer than the one in the database. Returns True if it was, so it is flooded on
+        """
+        address = summary["stationUDPAddress"]
+        if address == self.station.getStationUDPAddress():
+            return False
+        entry = self.entries.get(address)
+        if entry != None and summary["version"] <= entry.version:
+            return False
+        if (entry != None and "baseVersion" not in summary and summary["neighbours"] == entry.neighbours
+                and summary["timetable"] == self.encodeBuckets(entry.timetable)):
+            # a periodic summary of a timetable that has not changed
+            entry.version = summary["version"]
+            entry.receivedAt = ts.monotonic()
+            return True
+        timetable = Timetable(self.names, self.nameIds)
+        if "baseVersion" in summary:
+            if entry == None or entry.version != summary["baseVersion"]:
+                # missed the version the change applies to, the next full summary will bring the station up to date
+                return False
+            timetable.buckets = dict(entry.timetable.buckets)
+        for destinationName, columns in summary["timetable"].items():
+            destinationId = timetable.getNameId(destinationName)
+            departures, arrivals, lines, stops = columns
+            if len(departures) == 0:
+                timetable.buckets.pop(destinationId, None)
+                continue
+            rows = zip(departures, map(timetable.getNameId, lines),
+                       map(timetable.getNameId, stops), arrivals)
+            timetable.buckets[destinationId] = TimetableBucket(
+                destinationId, rows)
+        self.entries[address] = TopologyEntry(summary["stationName"], address, summary["version"],
+                                              summary["neighbours"], timetable)
+        self.changes = self.changes + 1
+        return True
+
+    def getEntries(self):
+        """
+        Get the entries of the other stations, dropping those that have not been refreshed for GOSSIP_MAX_AGE
+        """
+        now = ts.monotonic()
+        for address, entry in list(self.entries.items()):
+            if now - entry.receivedAt > GOSSIP_MAX_AGE:
+                print(
+                    f"No summary from {entry.stationName} for {GOSSIP_MAX_AGE}s. Dropping it.")
+                del self.entries[address]
+                self.changes = self.changes + 1
+        return list(self.entries.values())
+
+    def getNetwork(self):
+        """
+        Get the entries of this station and every station it can reach, by name. Returns None if a station in reach
+        has not sent a summary (e.g. a Java station or one that has just started), as routes through it are unknown.
+        """
+        station = self.station
+        entries = {station.getStationUDPAddress(): TopologyEntry(station.stationName, station.getStationUDPAddress(),
+                                                                 self.getVersion(),
+                                                                 [neighbour.getStationUDPAddress()
+                                                                  for neighbour in station.neighbours],
+                                                                 station.timetable)}
+        for entry in self.getEntries():
+            entries[entry.stationUDPAddress] = entry
+        network = {}
+        unvisited = [station.getStationUDPAddress()]
+        while len(unvisited) > 0:
+            entry = entries.get(unvisited.pop())
+            if entry == None:
+                return None
+            if entry.stationName in network:
+                continue
+            network[entry.stationName] = entry
+            unvisited.extend(entry.neighbours)
+        for entry in network.values():
+            entry.neighbourNames = [entries[address].stationName
+                                    for address in entry.neighbours]
+        return network
+
+    def getConnectionScan(self, network):
+        """
+        Get the connections of the network, built again only when a timetable has changed. Like a flooded query,
+        a station only goes on to its neighbours
+        """
+        version = (self.changes, self.station.timetableVersion)
+        if self.connectionScanVersion != version:
+            connectionScan = connectionscan.ConnectionScan()
+            for stationName, entry in network.items():
+                connectionScan.addTimetable(stationName, [record for record in entry.timetable
+                                                          if record[4] in entry.neighbourNames or record[4] not in network])
+            connectionScan.build()
+            self.connectionScan = connectionScan
+            self.connectionScanVersion = version
+        return self.connectionScan
+
+    def findRoute(self, msg):
+        """
+        Find the route of the query locally with the Connection Scan Algorithm, following the same trips a flooded
+        query does. Returns the message with the route filled in like a collated reply, or None if the database does
+        not cover the network the query would flood or the trip type is not FastestTrip.
+        """
+        if msg["tripType"] != "FastestTrip":
+            return None  # the connection scan only finds the earliest arrival
+        network = self.getNetwork()
+        if network == None:
+            return None
+        journey = self.getConnectionScan(network).earliestArrival(
+            msg["sourceName"], msg["destinationName"], msg["time"], floodRules=True)
+        msg["messageType"] = "incoming"
+        if journey == None:
+            msg["routeEndFound"] = True
+            return msg
+        route = [{
+            "stationName": stationName,
+            "messageId": 0,
+            "stationUDPAddress": network[stationName].stationUDPAddress,
+            "earliestTrips": [record]
+        } for stationName, record in journey]
+        route[0]["messageId"] = msg["route"][0]["messageId"]
+        msg["route"] = route
+        return msg
+
+
+class Timer:
+    """
+    A callback scheduled on a TimerHeap
+    """
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerHeap:
+    """
+    Heap of deadlines for the selectors engine. It has the same call_later(delay, callback, *args) method as an asyncio
+    event loop, so the routing code can schedule timers the same way on either engine.
+    """
+
+    def __init__(self):
+        self.timers = []
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.timers)
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(ts.monotonic() + delay, callback, args)
+        heapq.heappush(self.timers, (timer.deadline,
+                       next(self.counter), timer))
+        return timer
+
+    def getTimeout(self):
+        """
+        Get the time until the next timer is due, or None if there are no timers
+        """
+        while len(self.timers) > 0 and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+        if len(self.timers) == 0:
+            return None
+        return max(self.timers[0][0] - ts.monotonic(), 0)
+
+    def runDueTimers(self):
+        now = ts.monotonic()
+        while len(self.timers) > 0 and self.timers[0][0] <= now:
+            deadline, count, timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
 
 class ClientRequestLog:
     """
     Client Request log are used to stored request from the browser client. 
     The requests are held here until UDP communication is complete and a response can then be provided back to the client. 
+    The response is handed to data.respond, which either queues it on the socket (selectors engine) or resolves the
+    future the client coroutine is waiting on (asyncio engine).
+    Identical requests that arrive while the query is in flight wait on the same log, so clients maps every socket
+    waiting on the query to its data.
     """
 
-    def __init__(self, msg, sock, sel, data):
+    def __init__(self, msg, sock, data):
         self.msg = msg
-        self.sock = sock
-        self.sel = sel
-        self.data = data
+        self.clients = {sock: data}
+
+
+def getClientRequestKey(msg):
+    return (str(msg["sourceName"]), str(msg["destinationName"]), str(msg["messageId"]))
+
+
+def getClientQueryKey(msg):
+    """
+    Requests with the same key get the same answer, so only one query is sent out for them at a time. The time is
+    keyed in minutes, so "8:00" and "08:00" are the same query
+    """
+    return (str(msg["destinationName"]), getMinutes(msg["time"]), str(msg["tripType"]))
 
 
 class ClientRequestLogs:
     """
-    Individual requests from the browser client is stored in a list "logs". 
+    Individual requests from the browser client are stored in "logs".
+    Logs are indexed by (sourceName, destinationName, messageId), by the query (see getClientQueryKey) and by the
+    client sockets waiting on them.
     """
 
     def __init__(self):
-        self.logs = []
+        self.logsByKey = {}
+        self.logsByQuery = {}
+        self.logsBySocket = {}
+        self.coalesced = 0  # requests that waited on a query already in flight
+
+    def __len__(self):
+        return len(self.logsByKey)
+
+    @property
+    def logs(self):
+        return list(self.logsByKey.values())
 
     def addLog(self, log):
-        self.logs.append(log)
+        self.logsByKey[getClientRequestKey(log.msg)] = log
+        self.logsByQuery[getClientQueryKey(log.msg)] = log
+        for sock in log.clients:
+            self.logsBySocket[sock] = log
+
+    def attach(self, msg, sock, data):
+        """
+        Make the client wait on the log of an identical query that is in flight. Returns the log, or None if there is none
+        """
+        log = self.logsByQuery.get(getClientQueryKey(msg))
+        if log == None:
+            return None
+        log.clients[sock] = data
+        self.logsBySocket[sock] = log
+        self.coalesced = self.coalesced + 1
+        return log
+
+    def forget(self, log):
+        key = getClientQueryKey(log.msg)
+        if self.logsByQuery.get(key) is log:
+            del self.logsByQuery[key]
+        for sock in log.clients:
+            if self.logsBySocket.get(sock) is log:
+                del self.logsBySocket[sock]
 
     def removeLog(self, msg):
         removedLogs = []
-        for log in self.logs:
-            if log.msg["sourceName"] == msg["sourceName"] and log.msg["destinationName"] == msg["destinationName"] and log.msg["messageId"] == msg["messageId"]:
-                removedLogs.append(log)
-        for removedLog in removedLogs:
-            self.logs.remove(removedLog)
+        removedLog = self.logsByKey.pop(getClientRequestKey(msg), None)
+        if removedLog != None:
+            removedLogs.append(removedLog)
+            self.forget(removedLog)
         return removedLogs
 
     def getLog(self, msg):
-        for log in self.logs:
-            if log.msg["sourceName"] == msg["sourceName"] and log.msg["destinationName"] == msg["destinationName"] and log.msg["messageId"] == msg["messageId"]:
-                return log
+        return self.logsByKey.get(getClientRequestKey(msg))
+
+    def removeSocket(self, sock):
+        """
+        Remove the request the client socket is waiting on, e.g. when the client closes the connection
+        """
+        removedLog = self.logsBySocket.pop(sock, None)
+        if removedLog == None:
+            return None
+        removedLog.clients.pop(sock, None)
+        # the query is dropped once no client is waiting on it
+        if len(removedLog.clients) == 0:
+            if self.logsByKey.get(getClientRequestKey(removedLog.msg)) is removedLog:
+                del self.logsByKey[getClientRequestKey(removedLog.msg)]
+            self.forget(removedLog)
+        return removedLog
+
+    def removeConnection(self, sock, data):
+        """
+        Remove the requests a client connection is waiting on when it closes: its own, and each query of its
+        /api/routes request (keyed by (sock, index), see serviceBatchRequest)
+        """
+        self.removeSocket(sock)
+        for batchKey in data.batchKeys:
+            self.removeSocket(batchKey)
+        data.batchKeys = []
+
 
 
 class MessageSentLog:
@@ -142,31 +1050,72 @@ class MessageSentLog:
 
 class MessageSentLogs:
     """
-    All messages sent out from the server via UDP are stored in a MessageSentLogs object's logs. 
+    All messages sent out from the server via UDP are stored in a MessageSentLogs object's logs.
+    Logs are indexed by messageId and then by the destination station address, so adding, removing
+    and checking for logs does not depend on how many messages are still waiting for a reply.
     """
 
     def __init__(self):
-        self.logs = []
+        self.logsByMessageId = {}
+        self.deadlines = {}
+
+    def __len__(self):
+        return sum(len(logs) for logs in self.logsByMessageId.values())
+
+    @property
+    def logs(self):
+        return [log for logs in self.logsByMessageId.values() for log in logs.values()]
 
     def addLog(self, log):
-        self.logs.append(log)
+        if log.messageId not in self.logsByMessageId:
+            self.logsByMessageId[log.messageId] = {}
+        self.logsByMessageId[log.messageId][log.destinationStationAddress] = log
 
     def removeLog(self, parentAddress, destinationStationAddress, messageId):
-        for record in self.logs:
-            if str(record.parentAddress) == str(parentAddress) and str(record.destinationStationAddress) == str(destinationStationAddress) and str(record.messageId) == str(messageId):
-                self.logs.remove(record)
-                return record
-        return None
+        logs = self.logsByMessageId.get(str(messageId))
+        if logs == None:
+            return None
+        record = logs.get(str(destinationStationAddress))
+        if record == None or record.parentAddress != str(parentAddress):
+            return None
+        del logs[record.destinationStationAddress]
+        if len(logs) == 0:
+            del self.logsByMessageId[record.messageId]
+        return record
+
+    def hasLog(self, messageId, destinationStationAddress):
+        """
+        Check if the message has already been sent to the destination station
+        """
+        logs = self.logsByMessageId.get(str(messageId))
+        return logs != None and str(destinationStationAddress) in logs
+
+    def removeLogs(self, messageId):
+        """
+        Remove all logs still waiting for a reply to the messageId
+        """
+        logs = self.logsByMessageId.pop(str(messageId), {})
+        return list(logs.values())
+
+    def setDeadline(self, messageId, timer):
+        self.deadlines[str(messageId)] = timer
+
+    def cancelDeadline(self, messageId):
+        timer = self.deadlines.pop(str(messageId), None)
+        if timer != None:
+            timer.cancel()
+
+    def hasLogs(self, messageId):
+        """
+        Check if any message with the messageId is still waiting for a reply
+        """
+        return str(messageId) in self.logsByMessageId
 
     def getLogs(self, messageId):
-        foundLog = []
-        for record in self.logs:
-            if str(record.messageId) == str(messageId):
-                foundLog.append(record)
-        if len(foundLog) > 0:
-            return foundLog
-        else:
+        logs = self.logsByMessageId.get(str(messageId))
+        if logs == None:
             return None
+        return list(logs.values())
 
 
 class Message:
@@ -174,7 +1123,7 @@ class Message:
     This is the message that is used for inter-station communication via UDP. The message object is converted to JSON before sending.  
     """
 
-    def __init__(self, sourceName, destinationName, tripType, time, messageId, messageType):
+    def __init__(self, sourceName, destinationName, tripType, time, messageId, messageType, queryTimeout):
         self.sourceName = sourceName
         self.destinationName = destinationName
         self.route = []
@@ -184,40 +1133,453 @@ class Message:
         self.messageId = messageId
         self.messageType = messageType
         self.routeEndFound = False
+        self.queryTimeout = queryTimeout  # seconds the source waits for replies, each hop waits a fraction of it
 
     def addRoute(self, station):
         stationObject = station.getStationObject(self.messageId, self.time)
         self.route.append(stationObject)
 
 
+def getArrivalTime(message):
+    """
+    Get the arrival time (in minutes) at the destination of a returned message, or None if it did not find a route
+    """
+    if message["routeEndFound"] == True or len(message["route"][-1]["earliestTrips"]) == 0:
+        return None
+    return getMinutes(message["route"][-1]["earliestTrips"][0][3])
+
+
+def getRouteLegs(route, destinationName):
+    """
+    Get the trip each station of a route took to the next station (the last one to the destination)
+    """
+    legs = []
+    for index, stop in enumerate(route):
+        nextName = route[index + 1]["stationName"] if index + \
+            1 < len(route) else destinationName
+        for trip in stop["earliestTrips"]:
+            if trip[4] == nextName:
+                legs.append(trip)
+                break
+    return legs
+
+
+def getTransfers(legs):
+    """
+    Count the changes of line between the legs of a trip
+    """
+    return sum(1 for previous, leg in zip(legs, legs[1:]) if leg[1] != previous[1])
+
+
+def getTripKey(message):
+    """
+    Get the key of a returned message that is smallest for the best message of its trip type: (arrival time,) for
+    FastestTrip, (transfers, arrival time) for LeastTransfers. None if it did not find a route
+    """
+    arrivalTime = getArrivalTime(message)
+    if arrivalTime == None:
+        return None
+    if message["tripType"] == "LeastTransfers":
+        return (getTransfers(getRouteLegs(message["route"], message["destinationName"])), arrivalTime)
+    return (arrivalTime,)
+
+
+def getParetoRoutes(routes, destinationName):
+    """
+    Keep the routes that no other route beats on both arrival time and transfers, earliest arrival first
+    """
+    criteria = []
+    for index, route in enumerate(routes):
+        legs = getRouteLegs(route, destinationName)
+        criteria.append((getMinutes(legs[-1][3]), getTransfers(legs), index))
+    paretoRoutes = []
+    for arrival, transfers, index in sorted(criteria):
+        if len(paretoRoutes) == 0 or transfers < paretoRoutes[-1][0]:
+            paretoRoutes.append((transfers, routes[index]))
+    return [route for transfers, route in paretoRoutes]
+
+
 class MessageBank:
     """
-    The message bank is used to store incoming messages from other neighbouring stations. 
-    Only when all messages that were initially sent out has been returned, can the message be collated and removed from the message bank. 
+    The message bank is used to store incoming messages from other neighbouring stations.
+    Messages are grouped by the messageId of the hop they return to, and each group only keeps the best message received
+    so far (see getTripKey). For ParetoTrip the group keeps one message whose route arrives earliest and whose
+    "paretoRoutes" are the other routes that are not beaten on both arrival time and transfers.
+    Only when all messages that were initially sent out has been returned, can the message be collated and removed from
+    the message bank.
     """
 
     def __init__(self):
-        self.bank = []
+        self.bank = {}
+        self.incomplete = {}  # messageId: the lowest incomplete depth of the replies in the group
 
-    def addMessage(self, message):
-        self.bank.append(message)
+    def __len__(self):
+        return len(self.bank)
 
-    def removeMessage(self, hopCount, messageId):
-        removedMessages = []
+    def addMessage(self, message):
+        messageId = str(message["route"][message["hopCount"]]["messageId"])
+        bestMessage = self.bank.get(messageId)
+        tripKey = getTripKey(message)
+        incomplete = message.get("incomplete")
+        if incomplete != None:
+            self.incomplete[messageId] = min(
+                incomplete, self.incomplete.get(messageId, incomplete))
+        if tripKey == None:
+            # keep the group so collation knows replies have arrived, but there is no candidate to keep
+            if messageId not in self.bank:
+                self.bank[messageId] = None
+            return
+        if message["tripType"] == "ParetoTrip":
+            routes = [message["route"]] + message.get("paretoRoutes", [])
+            if bestMessage != None:
+                routes += [bestMessage["route"]] + \
+                    bestMessage.get("paretoRoutes", [])
+            routes = getParetoRoutes(routes, message["destinationName"])
+            message["route"] = routes[0]
+            message.pop("paretoRoutes", None)
+            if len(routes) > 1:
+                message["paretoRoutes"] = routes[1:]
+            self.bank[messageId] = message
+        # only replace the candidate if this message is strictly better
+        elif bestMessage == None or tripKey < getTripKey(bestMessage):
+            self.bank[messageId] = message
+
+    def removeIncomplete(self, messageId):
+        """
+        Remove and return the lowest incomplete depth of the replies in the group, or None if they were all complete
+        """
+        return self.incomplete.pop(str(messageId), None)
+
+    def removeMessage(self, messageId):
         print(f"Message Id to remove: {messageId}")
-        for message in self.bank:
-            # message["sourceName"] == sourceName and message["destinationName"] == destinationName and
-            try:
-                if message["route"][hopCount]["messageId"] == messageId:
-                    removedMessages.append(message)
-            except:
-                pass  # the message is some other message that doesn't have the same hopCount
+        removedMessage = self.bank.pop(str(messageId), None)
+        print(f"Removed message: {removedMessage}")
+        return removedMessage
+
+
+class ReliableUdpTransport:
+    """
+    Reliability layer under the inter-station protocol. It wraps the UDP socket (or asyncio datagram transport) and has
+    the same sendto(bytes, address) method, so the message handlers use it in place of the socket. sendMessage encodes
+    a message in the binary format for peers that have advertised the "binary" capability, else as JSON.
+    Datagrams to peers that have advertised the "reliable" capability are sent in an envelope with a sequence number,
+    acknowledged by the peer and retransmitted with exponential backoff until they are. Duplicates are suppressed on
+    receive. Datagrams to any other peer (e.g. Station.java) are sent as plain JSON, once.
+    With a batch window, messages to peers that have advertised the "batch" capability are held for up to the window
+    (or until they fill station.batchSize bytes) and sent together in one enveloped datagram.
+    """
+
+    def __init__(self, station, udpSocket):
+        self.station = station
+        self.udpSocket = udpSocket
+        self.reliablePeers = set()
+        self.binaryPeers = set()
+        self.peerCapabilities = {}  # address: set of the capabilities the peer has advertised
+        self.sequence = itertools.count(1)
+        self.bootId = int.from_bytes(os.urandom(4), "big")
+        self.peerBoots = {}  # address: boot id of the peer's envelopes, reset its state when it changes
+        self.pending = {}  # (address, seq): timer of the next retransmission
+        self.inFlight = Counter()  # address: number of unacknowledged datagrams
+        self.queued = {}  # address: deque of (kind, body) waiting for room in the send window
+        self.received = {}  # address: (set, deque) of the recently received sequence numbers
+        self.batches = {}  # address: [list of messages, bytes, flush timer] waiting to be sent together
+        # (address, boot id, message seq): Reassembly of a fragmented message, oldest first
+        self.reassemblies = OrderedDict()
+        self.reassemblyBytes = 0
+        # datagramsSent and datagramsReceived count the sendto and recvfrom system calls
+        self.counters = Counter(sent=0, retransmissions=0, acks=0, duplicates=0, dropped=0,
+                                fragments=0, reassembled=0, evicted=0, oversized=0, malformed=0, batches=0, batched=0,
+                                datagramsSent=0, datagramsReceived=0)
+
+    def addPeerCapabilities(self, address, capabilities):
+        """
+        Record the capabilities a peer has advertised in its message. Returns the capabilities that are new for the peer
+        """
+        address = tuple(address)
+        if capabilities == None:
+            return set()
+        if "reliable" in capabilities:
+            self.reliablePeers.add(address)
+        if "binary" in capabilities:
+            self.binaryPeers.add(address)
+        known = self.peerCapabilities.setdefault(address, set())
+        newCapabilities = set(capabilities) - known
+        known.update(newCapabilities)
+        return newCapabilities
+
+    def hasCapability(self, address, capability):
+        return capability in self.peerCapabilities.get(tuple(address), ())
+
+    def sendMessage(self, msg, address, encodings=None):
+        """
+        Encode the message in the best format the peer understands and send it, advertising this station's capabilities.
+        encodings caches the encoded message by format when the same message is sent to several peers
+        """
+        address = tuple(address)
+        msg["capabilities"] = self.station.capabilities
+        if encodings == None:
+            encodings = {}
+        wireFormat = "json"
+        if address in self.binaryPeers and "binary" in self.station.capabilities:
+            wireFormat = "binary"
+        data = encodings.get(wireFormat)
+        if data == None:
+            data = encodeMessage(msg, wireFormat)
+            encodings[wireFormat] = data
+        self.sendto(data, address)
+
+    def sendto(self, data, address):
+        address = tuple(address)
+        self.counters["sent"] += 1
+        if address not in self.reliablePeers:
+            if len(data) > MESSAGE_SIZE:
+                # the peer has not told us it can reassemble fragments
+                self.counters["oversized"] += 1
+                print(
+                    f"Message of {len(data)} bytes is too large to send to {address} in one datagram. Dropping it.")
+                return
+            self.sendDatagram(data, address)
+            return
+        if self.station.batchWindow != None and address in self.peerCapabilities and \
+                "batch" in self.peerCapabilities[address]:
+            self.addToBatch(data, address)
+            return
+        self.sendData(data, address)
+
+    def sendData(self, data, address):
+        """
+        Send a message to a reliable peer in one envelope, or in fragments if it is too long
+        """
+        if len(data) <= FRAGMENT_SIZE:
+            self.sendEnvelope(KIND_DATA, data, address)
+            return
+        messageSeq = next(self.sequence) & 0xFFFFFFFF
+        count = (len(data) + FRAGMENT_SIZE - 1) // FRAGMENT_SIZE
+        for index in range(count):
+            fragment = data[index * FRAGMENT_SIZE:(index + 1) * FRAGMENT_SIZE]
+            self.sendEnvelope(KIND_FRAGMENT, FRAGMENT.pack(
+                messageSeq, index, count) + fragment, address)
+            self.counters["fragments"] += 1
+
+    def addToBatch(self, data, address):
+        """
+        Hold the message until the batch to the peer is full or its window has passed
+        """
+        batch = self.batches.get(address)
+        if batch != None and batch[1] + 2 + len(data) > self.station.batchSize:
+            self.flush(address)
+            batch = None
+        if 2 + len(data) > self.station.batchSize:
+            self.sendData(data, address)
+            return
+        if batch == None:
+            batch = [[], 0, self.station.timers.call_later(
+                self.station.batchWindow, self.flush, address)]
+            self.batches[address] = batch
+        batch[0].append(data)
+        batch[1] += 2 + len(data)
+
+    def flush(self, address):
+        """
+        Send the messages batched for the peer, in one datagram if there are several
+        """
+        batch = self.batches.pop(address, None)
+        if batch == None:
+            return
+        messages, size, timer = batch
+        timer.cancel()
+        if len(messages) == 1:
+            self.sendEnvelope(KIND_DATA, messages[0], address)
+            return
+        self.counters["batches"] += 1
+        self.counters["batched"] += len(messages)
+        self.sendEnvelope(KIND_BATCH, b"".join(
+            len(message).to_bytes(2, "big") + message for message in messages), address)
+
+    def sendDatagram(self, datagram, address):
+        self.counters["datagramsSent"] += 1
+        self.udpSocket.sendto(datagram, address)
+
+    def sendEnvelope(self, kind, body, address):
+        """
+        Send the body in an envelope and retransmit it until it is acknowledged. If the send window to the peer is
+        full, the body is queued until an earlier datagram is acknowledged.
+        """
+        if self.inFlight[address] >= SEND_WINDOW:
+            self.queued.setdefault(address, deque()).append((kind, body))
+            return
+        self.inFlight[address] += 1
+        seq = next(self.sequence) & 0xFFFFFFFF
+        datagram = ENVELOPE.pack(
+            ENVELOPE_MAGIC, ENVELOPE_VERSION, kind, self.bootId, seq) + body
+        self.sendDatagram(datagram, address)
+        self.pending[(address, seq)] = self.station.timers.call_later(
+            RETRANSMIT_TIMEOUT, self.retransmit, datagram, address, seq, 1)
+
+    def retransmit(self, datagram, address, seq, attempt):
+        if (address, seq) not in self.pending:
+            return
+        if attempt > RETRANSMIT_ATTEMPTS:
+            del self.pending[(address, seq)]
+            self.counters["dropped"] += 1
+            print(
+                f"No ACK from {address} for datagram {seq} after {RETRANSMIT_ATTEMPTS} retransmissions. Giving up. {self.getCounters()}")
+            self.sendQueued(address)
+            return
+        self.counters["retransmissions"] += 1
+        self.sendDatagram(datagram, address)
+        self.pending[(address, seq)] = self.station.timers.call_later(
+            RETRANSMIT_TIMEOUT * 2 ** attempt, self.retransmit, datagram, address, seq, attempt + 1)
+
+    def sendQueued(self, address):
+        """
+        An earlier datagram to the peer is done with, so send the next queued one
+        """
+        self.inFlight[address] -= 1
+        queued = self.queued.get(address)
+        if queued:
+            kind, body = queued.popleft()
+            self.sendEnvelope(kind, body, address)
+
+    def receive(self, datagram, address):
+        """
+        Unwrap a datagram from a peer. Acknowledge enveloped data and return the list of messages it carried, which is
+        empty if the datagram carried nothing new (an ACK or a duplicate). Plain JSON datagrams are returned as they are.
+        """
+        self.counters["datagramsReceived"] += 1
+        if not datagram.startswith(ENVELOPE_MAGIC):
+            return [datagram]
+        address = tuple(address)
+        magic, version, kind, bootId, seq = ENVELOPE.unpack_from(datagram)
+        if version != ENVELOPE_VERSION:
+            print(f"Unknown envelope version {version} from {address}")
+            return []
+        # a peer that sends envelopes understands them
+        self.reliablePeers.add(address)
+        if self.peerBoots.get(address) != bootId:
+            self.resetPeer(address, bootId)
+        if kind == KIND_ACK:
+            timer = self.pending.pop((address, seq), None)
+            if timer != None:
+                timer.cancel()
+                self.sendQueued(address)
+            return []
+        self.sendDatagram(ENVELOPE.pack(
+            ENVELOPE_MAGIC, ENVELOPE_VERSION, KIND_ACK, self.bootId, seq), address)
+        self.counters["acks"] += 1
+        seen, order = self.received.setdefault(address, (set(), deque()))
+        if seq in seen:
+            self.counters["duplicates"] += 1
+            return []
+        seen.add(seq)
+        order.append(seq)
+        if len(order) > DUPLICATE_WINDOW:
+            seen.discard(order.popleft())
+        if kind == KIND_FRAGMENT:
+            message = self.reassemble(datagram, address, bootId)
+            return [] if message == None else [message]
+        if kind == KIND_BATCH:
+            return self.unbatch(datagram)
+        return [datagram[ENVELOPE.size:]]
+
+    def resetPeer(self, address, bootId):
+        """
+        The peer has (re)started: its sequence numbers start again, so forget the ones received from it before, and
+        the messages it was part way through sending
+        """
+        if address in self.peerBoots:
+            print(f"Station at {address} has restarted.")
+            self.received.pop(address, None)
+            for key in [key for key in self.reassemblies if key[0] == address]:
+                self.removeReassembly(key)
+        self.peerBoots[address] = bootId
+
+    def unbatch(self, datagram):
+        """
+        Split a batch into its messages
+        """
+        messages = []
+        offset = ENVELOPE.size
+        while offset + 2 <= len(datagram):
+            length = int.from_bytes(datagram[offset:offset + 2], "big")
+            messages.append(datagram[offset + 2:offset + 2 + length])
+            offset += 2 + length
+        return messages
+
+    def reassemble(self, datagram, address, bootId):
+        """
+        Add a fragment to the reassembly of its message. Return the message once all of its fragments have arrived,
+        else None. The oldest reassemblies are dropped when they time out or the memory budget is used up. A fragment
+        whose index or count does not fit its message is dropped.
+        """
+        if len(datagram) < ENVELOPE.size + FRAGMENT.size:
+            print(f"Dropping a truncated fragment from {address}.")
+            self.counters["malformed"] += 1
+            return None
+        messageSeq, index, count = FRAGMENT.unpack_from(
+            datagram, ENVELOPE.size)
+        fragment = datagram[ENVELOPE.size + FRAGMENT.size:]
+        key = (address, bootId, messageSeq)
+        reassembly = self.reassemblies.get(key)
+        if index >= count or (reassembly != None and count != reassembly.count):
+            print(f"Dropping fragment {index}/{count} of message {messageSeq} from {address}.")
+            self.counters["malformed"] += 1
+            return None
+        if reassembly == None:
+            reassembly = Reassembly(count)
+            self.reassemblies[key] = reassembly
+        if index in reassembly.fragments:
+            return None
+        reassembly.fragments[index] = fragment
+        reassembly.size += len(fragment)
+        self.reassemblyBytes += len(fragment)
+        if len(reassembly.fragments) == reassembly.count:
+            self.removeReassembly(key)
+            self.counters["reassembled"] += 1
+            return b"".join(reassembly.fragments[i] for i in range(reassembly.count))
+        # drop the oldest reassemblies that have timed out or do not fit in the budget
+        now = ts.monotonic()
+        while len(self.reassemblies) > 0:
+            oldestKey, oldest = next(iter(self.reassemblies.items()))
+            if self.reassemblyBytes <= REASSEMBLY_BUDGET and now - oldest.started <= REASSEMBLY_TIMEOUT:
+                break
+            print(
+                f"Dropping the reassembly of message {oldestKey[2]} from {oldestKey[0]} ({len(oldest.fragments)}/{oldest.count} fragments).")
+            self.removeReassembly(oldestKey)
+            self.counters["evicted"] += 1
+        return None
+
+    def removeReassembly(self, key):
+        reassembly = self.reassemblies.pop(key)
+        self.reassemblyBytes -= reassembly.size
+
+    def getCounters(self):
+        return dict(self.counters, syscalls=self.counters["datagramsSent"] + self.counters["datagramsReceived"],
+                    pending=len(self.pending), queued=sum(len(queued) for queued in self.queued.values()),
+                    reassembling=len(self.reassemblies),
+                    reassemblyBytes=self.reassemblyBytes)
 
-        for removedMessage in removedMessages:
-            self.bank.remove(removedMessage)
-            print(f"Removed message: {removedMessage}")
 
-        return removedMessages
+class Reassembly:
+    """
+    The fragments received so far of a fragmented message
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.fragments = {}  # index: bytes
+        self.size = 0
+        self.started = ts.monotonic()
+
+
+def setUdpBufferSize(udpSocket, size):
+    """
+    Set the receive and send buffer sizes of the UDP socket. The OS may round or cap them (e.g. net.core.rmem_max)
+    """
+    udpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    udpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, size)
+    print(
+        f"UDP buffers: SO_RCVBUF {udpSocket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)} || SO_SNDBUF {udpSocket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)}")
 
 
 # here is the html content used
@@ -334,38 +1696,293 @@ html_content = """
     }});
 </script>
 """
+# fields of html_content filled in for each response, the others only change with the timetable
+HTML_DYNAMIC_FIELDS = ["summarisedTrip",
+                       "stationResponse", "responses", "routeEndFound"]
+
 
+class HtmlPage:
+    """
+    html_content rendered for the station's current timetable. The static fields are formatted and the page encoded
+    once per timetable version, leaving the parts between the dynamic fields as bytes, so a response only encodes the
+    route result. The landing page (no route result) is kept whole, with an ETag of its content.
+    """
 
-def acceptTcpWrapper(sock, sel):
+    def __init__(self, station):
+        self.station = station
+        self.parts = None  # bytes of the page between the dynamic fields, with the field names in between
+        self.landingPage = None
+        self.etag = None
+
+    def clear(self, changedDestinations=None):
+        self.parts = None
+
+    def render(self):
+        station = self.station
+        # mark where the dynamic fields go, as the formatted page cannot be formatted again
+        markers = {name: f"\x00{name}\x00" for name in HTML_DYNAMIC_FIELDS}
+        text = html_content.format(station=station.stationName,
+                                   timetable=station.timetable.getRecords(),
+                                   stationTcpAddress=station.getStationTCPAddress(),
+                                   tripTypes=TRIP_TYPE,
+                                   **markers)
+        self.parts = [part if index % 2 == 1 else part.encode(FORMAT)
+                      for index, part in enumerate(text.split("\x00"))]
+        self.landingPage = self.fill(
+            stationResponse="false", responses=[[]], routeEndFound="false", summarisedTrip="")
+        self.etag = f'"{hashlib.sha1(self.landingPage).hexdigest()[:16]}"'
+
+    def fill(self, **fields):
+        """
+        Get the page with the dynamic fields filled in
+        """
+        if self.parts == None:
+            self.render()
+        return b"".join(part if index % 2 == 0 else str(fields[part]).encode(FORMAT)
+                        for index, part in enumerate(self.parts))
+
+    def getLandingPage(self):
+        """
+        Get the landing page and its ETag
+        """
+        if self.parts == None:
+            self.render()
+        return self.landingPage, self.etag
+
+
+def acceptTcpWrapper(sock, sel, station, clientRequestLogs):
     """
     Accept the TCP request
     """
     conn, addr = sock.accept()  # Should be ready to read
     conn.setblocking(False)
-    # create a data object that holds addr, inb and outb
-    data = types.SimpleNamespace(addr=addr, inb=b'', outb=b'')
-    events = selectors.EVENT_READ | selectors.EVENT_WRITE
-    # register the client socket
-    sel.register(conn, events, data=data)
+    # create a data object that holds addr, the request parser, outb and the state of the connection
+    data = types.SimpleNamespace(addr=addr, parser=HttpRequestParser(), outb=b'', state="reading", keepAlive=False,
+                                 requests=0, batchKeys=[], lastRead=ts.monotonic(), idleTimer=None)
+    data.respond = lambda response: queueTcpResponse(conn, sel, data, response)
+    # register the client socket for reading only until a request has been parsed
+    sel.register(conn, selectors.EVENT_READ, data=data)
+    startIdleTimer(station, conn, sel, data, clientRequestLogs)
+
+
+def queueTcpResponse(sock, sel, data, response):
+    """
+    Queue the response for the client and register the socket for writing
+    """
+    if data.state == "closed":
+        print(f"Client {data.addr} has already closed the connection.")
+        return
+    data.outb += response
+    data.state = "writing"
+    sel.modify(sock, selectors.EVENT_WRITE, data=data)
+
+
+def closeTcpConnection(sock, sel, data, clientRequestLogs):
+    """
+    Close the client socket and forget any request it was waiting on
+    """
+    if data.state == "closed":
+        return
+    print('closing connection to', data.addr)
+    data.state = "closed"
+    clientRequestLogs.removeConnection(sock, data)
+    sel.unregister(sock)
+    sock.close()
+
+
+def startIdleTimer(station, sock, sel, data, clientRequestLogs):
+    """
+    Close the connection once it is reading and has sent nothing for KEEP_ALIVE_TIMEOUT seconds, like the asyncio
+    engine does. One timer per connection is kept, and it is started again whenever the connection goes back to
+    reading
+    """
+    if data.idleTimer == None:
+        data.idleTimer = station.timers.call_later(KEEP_ALIVE_TIMEOUT, closeIdleTcpConnection,
+                                                   station, sock, sel, data, clientRequestLogs)
+
+
+def closeIdleTcpConnection(station, sock, sel, data, clientRequestLogs):
+    """
+    Close a connection that has not sent anything (e.g. the rest of a request, or its next request after the last
+    one was answered) for KEEP_ALIVE_TIMEOUT seconds
+    """
+    data.idleTimer = None
+    if data.state != "reading":
+        return
+    idle = ts.monotonic() - data.lastRead
+    if idle < KEEP_ALIVE_TIMEOUT:
+        data.idleTimer = station.timers.call_later(KEEP_ALIVE_TIMEOUT - idle, closeIdleTcpConnection,
+                                                   station, sock, sel, data, clientRequestLogs)
+        return
+    print(f"Connection to {data.addr} is idle.")
+    closeTcpConnection(sock, sel, data, clientRequestLogs)
+
+
+class HttpRequest:
+    """
+    A request parsed by the HttpRequestParser. headers are keyed by their lower case names and query is the query
+    string of the target, still encoded (see getRequestObject)
+    """
+
+    def __init__(self, method, target, version, headers, body):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.body = body
+        url = urllib.parse.urlsplit(target)
+        self.path = urllib.parse.unquote(url.path)
+        self.query = url.query
+
+    @property
+    def keepAlive(self):
+        """
+        HTTP/1.1 connections are kept open unless the client asks to close them, HTTP/1.0 ones only if it asks to keep them
+        """
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return "keep-alive" in connection
+        return "close" not in connection
+
+    def acceptsEncoding(self, coding):
+        """
+        Check if the Accept-Encoding header allows the content coding (e.g. "gzip"): it is listed, or "*" is and the
+        coding is not, with a quality above 0 ("gzip;q=0" means gzip is not acceptable)
+        """
+        qualities = {}
+        for item in self.headers.get("accept-encoding", "").split(","):
+            name, *parameters = [part.strip() for part in item.split(";")]
+            quality = 1.0
+            for parameter in parameters:
+                key, separator, value = parameter.partition("=")
+                if key.strip().lower() == "q":
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            if name != "":
+                qualities[name.lower()] = quality
+        return qualities.get(coding, qualities.get("*", 0.0)) > 0
+
+
+class RequestTooLarge(ValueError):
+    """
+    A request or the data sent ahead of its answer is too large, answered with 413 Payload Too Large
+    """
+
+
+class HttpRequestParser:
+    """
+    Incremental HTTP/1.1 request parser. Feed it the bytes read from a connection as they arrive, and getRequest
+    returns each request once all of it has been received, so a keep-alive connection can send one request after
+    another (or several at once). Request bodies are read by Content-Length.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Add the bytes read from the connection. Raises RequestTooLarge if the client has sent more than
+        MAX_BUFFER_SIZE bytes that are not yet answered (e.g. while its last request is waiting for a route)
+        """
+        if len(self.buffer) + len(data) > MAX_BUFFER_SIZE:
+            raise RequestTooLarge("too much data sent ahead of the answer")
+        self.buffer += data
+
+    def getRequest(self):
+        """
+        Remove and return the next complete request, or None if it has not all arrived yet.
+        Raises a ValueError if the request is malformed or its header is too large, and RequestTooLarge if its body
+        is larger than MAX_BODY_SIZE
+        """
+        # blank lines between requests are ignored
+        while self.buffer[:2] == b"\r\n":
+            del self.buffer[:2]
+        while self.buffer[:1] == b"\n":
+            del self.buffer[:1]
+        # browsers end the header with CRLF CRLF, hand-typed requests may use bare LFs
+        ends = [(index, len(separator)) for separator in (b"\r\n\r\n", b"\n\n")
+                for index in [self.buffer.find(separator)] if index >= 0]
+        if len(ends) == 0:
+            if len(self.buffer) > MAX_HEADER_SIZE:
+                raise ValueError("request header is too large")
+            return None
+        headerEnd, separatorLength = min(ends)
+        if headerEnd > MAX_HEADER_SIZE:
+            raise ValueError("request header is too large")
+        lines = bytes(self.buffer[:headerEnd]).decode(
+            "latin-1").replace("\r\n", "\n").split("\n")
+        requestLine = lines[0].split(" ")
+        if len(requestLine) != 3 or not requestLine[2].startswith("HTTP/1."):
+            raise ValueError(f"malformed request line {lines[0]!r}")
+        method, target, version = requestLine
+        headers = {}
+        for line in lines[1:]:
+            name, separator, value = line.partition(":")
+            if separator == "" or name.strip() == "":
+                raise ValueError(f"malformed header {line!r}")
+            headers[name.strip().lower()] = value.strip()
+        if "transfer-encoding" in headers:
+            raise ValueError("chunked request bodies are not supported")
+        contentLength = int(headers.get("content-length", "0"))
+        if contentLength < 0:
+            raise ValueError("negative Content-Length")
+        if contentLength > MAX_BODY_SIZE:
+            raise RequestTooLarge(f"request body of {contentLength} bytes is too large")
+        requestEnd = headerEnd + separatorLength + contentLength
+        if len(self.buffer) < requestEnd:
+            return None
+        body = bytes(self.buffer[headerEnd + separatorLength:requestEnd])
+        del self.buffer[:requestEnd]
+        return HttpRequest(method, target, version, headers, body)
 
 
-def getRequestBody(request_array):
+def getHttpErrorResponse(status):
     """
-    Get the reqest body
+    Get a response with the status (e.g. "400 Bad Request") that closes the connection
     """
-    return str(request_array[0]).split(" ")[1].replace("/?", "")
+    return f"HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode()
 
 
-def getRequestObject(request_body):
+def getBadRequestStatus(exception):
     """
-    Get the request object
+    Get the status a request the parser rejected with the exception is answered with
     """
-    request_body_objects = []
-    request_body = request_body.split("&")
-    for item in request_body:
-        pair = item.split("=")
-        request_body_objects.append({pair[0]: pair[1]})
-    return request_body_objects
+    if isinstance(exception, RequestTooLarge):
+        return "413 Payload Too Large"
+    return "400 Bad Request"
+
+
+def getRequestObject(query):
+    """
+    Get the request object: a {name: value} dict for each parameter of the query string, decoded
+    """
+    return [{name: value} for name, value in urllib.parse.parse_qsl(query, keep_blank_values=True)]
+
+
+def isValidTime(time):
+    """
+    Check if the time is "HH:MM" (or "H:MM") with hours 0-23 and minutes 0-59
+    """
+    hour, separator, minute = time.partition(":")
+    return (separator == ":" and 1 <= len(hour) <= 2 and len(minute) == 2 and (hour + minute).isascii() and
+            (hour + minute).isdigit() and int(hour) < 24 and int(minute) < 60)
+
+
+def checkRequestObject(requestObject):
+    """
+    Check the parameters of a query before it is started. An empty time means now, and an empty trip type FastestTrip.
+    Raises a ValueError if one is invalid
+    """
+    for item in requestObject:
+        time = item.get("time")
+        if time != None and time != "" and not isValidTime(time):
+            raise ValueError(f"invalid time {time!r}, use HH:MM")
+        tripType = item.get("tripType")
+        if tripType != None and tripType != "" and tripType not in TRIP_TYPE:
+            raise ValueError(f"unknown trip type {tripType!r}, use one of {', '.join(TRIP_TYPE)}")
+
 
 
 def matchRoute(msg):
@@ -389,13 +2006,303 @@ def matchRoute(msg):
     return msg
 
 
+def encodeMessage(msg, wireFormat="json"):
+    """
+    Encode the message to send to another station. The binary format falls back to JSON for messages it cannot hold.
+    """
+    if wireFormat == "binary":
+        try:
+            return encodeBinaryMessage(msg)
+        except (AttributeError, KeyError, TypeError, ValueError, OverflowError) as exception:
+            print(f"Sending the message as JSON: {exception}")
+    return json.dumps(msg).encode(FORMAT)
+
+
+def decodeMessage(data):
+    """
+    Decode a message from another station in either format. Raises ValueError if it is neither
+    """
+    if data.startswith(BINARY_MAGIC):
+        try:
+            return decodeBinaryMessage(data)
+        except (IndexError, struct.error, UnicodeDecodeError) as exception:
+            raise ValueError(f"invalid binary message: {exception}")
+    return json.loads(data.decode(FORMAT))
+
+
+def encodeMessageId(messageId):
+    """
+    Pack a messageId: a tag then 16 bytes for a uuid int (Python stations) or the length and UTF-8 of a string
+    (Java stations)
+    """
+    if type(messageId) is int:
+        return b"\x00" + messageId.to_bytes(16, "big")
+    if type(messageId) is str:
+        encoded = messageId.encode(FORMAT)
+        return b"\x01" + len(encoded).to_bytes(2, "big") + encoded
+    raise TypeError(f"messageId of type {type(messageId).__name__}")
+
+
+def encodeBinaryMessage(msg):
+    """
+    Pack the message into the binary format:
+    header, [queryTimeout], counts, string table (size then UTF-8 text of NUL separated strings), references into the
+    string table, messageIds, [timetableVersions].
+    The counts are the number of capabilities, stations in the route and trips of each station. The references are
+    sourceName, destinationName, tripType, time, the capabilities, then for each station its stationName,
+    stationUDPAddress and earliestTrips (5 references per trip).
+    Raises an exception if the message has anything the format cannot hold.
+    """
+    if not BINARY_FIELDS.issuperset(msg):
+        raise ValueError(f"unknown fields {set(msg) - BINARY_FIELDS}")
+    flags = 0
+    if msg["messageType"] == "incoming":
+        flags |= BINARY_INCOMING
+    elif msg["messageType"] != "outgoing":
+        raise ValueError(f"messageType {msg['messageType']}")
+    if msg["routeEndFound"]:
+        flags |= BINARY_ROUTE_END_FOUND
+    incomplete = msg.get("incomplete")
+    if incomplete != None:
+        flags |= BINARY_INCOMPLETE
+    queryTimeout = msg.get("queryTimeout")
+    if queryTimeout != None:
+        flags |= BINARY_QUERY_TIMEOUT
+    capabilities = msg.get("capabilities", [])
+    counts = array("H", [len(capabilities), len(msg["route"])])
+    values = [msg["sourceName"], msg["destinationName"],
+              msg["tripType"], msg["time"]]
+    values += capabilities
+    messageIds = [encodeMessageId(msg["messageId"])]
+    timetableVersions = []
+    for stop in msg["route"]:
+        if not BINARY_STOP_FIELDS.issuperset(stop):
+            raise ValueError(
+                f"unknown route fields {set(stop) - BINARY_STOP_FIELDS}")
+        trips = stop["earliestTrips"]
+        if not {5}.issuperset(map(len, trips)):
+            raise ValueError("trips must have 5 fields")
+        counts.append(len(trips))
+        values.append(stop["stationName"])
+        values.append(stop["stationUDPAddress"])
+        values += itertools.chain.from_iterable(trips)
+        messageIds.append(encodeMessageId(stop["messageId"]))
+        timetableVersion = stop.get("timetableVersion", "").encode(FORMAT)
+        timetableVersions.append(len(timetableVersion).to_bytes(
+            2, "big") + timetableVersion)
+    if any(stop.get("timetableVersion") for stop in msg["route"]):
+        flags |= BINARY_TIMETABLE_VERSIONS
+    # each distinct string is stored once, in order of first appearance, separated by NUL
+    strings = list(dict.fromkeys(values))
+    text = "\x00".join(strings).encode(FORMAT)
+    if text.count(b"\x00") != len(strings) - 1:
+        raise ValueError("strings must not contain NUL")
+    table = dict(zip(strings, range(len(strings))))
+    refs = array("H", operator.itemgetter(*values)(table))
+    if sys.byteorder == "little":
+        counts.byteswap()
+        refs.byteswap()
+    parts = [BINARY_HEADER.pack(
+        BINARY_MAGIC, BINARY_VERSION, flags, msg["hopCount"])]
+    if queryTimeout != None:
+        parts.append(struct.pack("!d", queryTimeout))
+    parts += [counts.tobytes(), struct.pack("!I", len(text)), text,
+              refs.tobytes()]
+    parts += messageIds
+    if flags & BINARY_TIMETABLE_VERSIONS:
+        parts += timetableVersions
+    if incomplete != None:
+        parts.append(struct.pack("!H", incomplete))
+    return b"".join(parts)
+
+
+def decodeBinaryMessage(data):
+    """
+    Unpack a message in the binary format (see encodeBinaryMessage) into the same dict json.loads would give
+    """
+    magic, version, flags, hopCount = BINARY_HEADER.unpack_from(data)
+    if version != BINARY_VERSION:
+        raise ValueError(f"binary message version {version}")
+    offset = BINARY_HEADER.size
+    queryTimeout = None
+    if flags & BINARY_QUERY_TIMEOUT:
+        queryTimeout = struct.unpack_from("!d", data, offset)[0]
+        offset += 8
+    capabilityCount, stopCount = struct.unpack_from("!HH", data, offset)
+    offset += 4
+    tripCounts = array("H", data[offset:offset + 2 * stopCount])
+    offset += 2 * stopCount
+    if sys.byteorder == "little":
+        tripCounts.byteswap()
+    textSize = struct.unpack_from("!I", data, offset)[0]
+    offset += 4
+    strings = data[offset:offset + textSize].decode(FORMAT).split("\x00")
+    offset += textSize
+    refCount = 4 + capabilityCount + 2 * stopCount + 5 * sum(tripCounts)
+    refs = array("H", data[offset:offset + 2 * refCount])
+    offset += 2 * refCount
+    if sys.byteorder == "little":
+        refs.byteswap()
+    if len(refs) != refCount:
+        raise IndexError("message is truncated")
+    values = list(map(strings.__getitem__, refs))
+
+    messageIds = []
+    for index in range(1 + stopCount):
+        if data[offset] == 0:
+            messageIds.append(int.from_bytes(
+                data[offset + 1:offset + 17], "big"))
+            offset += 17
+        else:
+            length = int.from_bytes(data[offset + 1:offset + 3], "big")
+            messageIds.append(
+                data[offset + 3:offset + 3 + length].decode(FORMAT))
+            offset += 3 + length
+    if offset > len(data):
+        raise IndexError("message is truncated")
+
+    route = []
+    position = 4 + capabilityCount
+    for index in range(stopCount):
+        tripsEnd = position + 2 + 5 * tripCounts[index]
+        route.append({
+            "stationName": values[position],
+            "messageId": messageIds[1 + index],
+            "stationUDPAddress": values[position + 1],
+            "earliestTrips": [values[trip:trip + 5] for trip in range(position + 2, tripsEnd, 5)]
+        })
+        position = tripsEnd
+    if flags & BINARY_TIMETABLE_VERSIONS:
+        for stop in route:
+            length = int.from_bytes(data[offset:offset + 2], "big")
+            if offset + 2 + length > len(data):
+                raise IndexError("message is truncated")
+            if length > 0:
+                stop["timetableVersion"] = data[offset +
+                                                2:offset + 2 + length].decode(FORMAT)
+            offset += 2 + length
+    incomplete = None
+    if flags & BINARY_INCOMPLETE:
+        if offset + 2 > len(data):
+            raise IndexError("message is truncated")
+        incomplete = struct.unpack_from("!H", data, offset)[0]
+    msg = {
+        "sourceName": values[0],
+        "destinationName": values[1],
+        "route": route,
+        "tripType": values[2],
+        "hopCount": hopCount,
+        "time": values[3],
+        "messageId": messageIds[0],
+        "messageType": "incoming" if flags & BINARY_INCOMING else "outgoing",
+        "routeEndFound": bool(flags & BINARY_ROUTE_END_FOUND),
+        "queryTimeout": queryTimeout,
+        "capabilities": values[4:4 + capabilityCount]
+    }
+    if incomplete != None:
+        msg["incomplete"] = incomplete
+    return msg
+
+
+def sendProbes(station, udpServerSocket):
+    """
+    Ask the neighbours for their capabilities with a message that is not intended for any station. Python and Java
+    stations alike send it straight back, and Python stations add their capabilities to it.
+    """
+    message = vars(Message(station.stationName, "", TRIP_TYPE[0], "00:00", 0,
+                           "outgoing", station.queryTimeout))
+    message["route"].append({
+        "stationName": station.stationName,
+        "messageId": 0,
+        "stationUDPAddress": station.getStationUDPAddress(),
+        "earliestTrips": []
+    })
+    encodings = {}
+    for neighbour in station.neighbours:
+        udpServerSocket.sendMessage(
+            message, neighbour.udp_address, encodings)
+
+
+def getGossipMessage(station, summaries):
+    return json.dumps({"messageType": "gossip", "capabilities": station.capabilities,
+                       "summaries": summaries}).encode(FORMAT)
+
+
+def sendGossip(station, udpServerSocket, summaries, exceptAddress=None):
+    """
+    Send timetable summaries to the neighbours that take part in gossip routing. Other stations (e.g. Station.java)
+    would not understand the message, so they are never sent one
+    """
+    data = getGossipMessage(station, summaries)
+    for neighbour in station.neighbours:
+        address = neighbour.udp_address
+        if address != exceptAddress and udpServerSocket.hasCapability(address, "gossip"):
+            udpServerSocket.sendto(data, address)
+
+
+def gossipTimetable(station, udpServerSocket, changedDestinations=None):
+    """
+    Flood a summary of this station's timetable (or of the destinations that changed) to the network
+    """
+    sendGossip(station, udpServerSocket,
+               [station.topology.originate(changedDestinations)])
+
+
+def gossipPeriodically(station, udpServerSocket):
+    """
+    Flood a full summary every GOSSIP_INTERVAL, so summaries that were lost are replaced and other stations know this
+    one is still running
+    """
+    gossipTimetable(station, udpServerSocket)
+    station.timers.call_later(
+        GOSSIP_INTERVAL, gossipPeriodically, station, udpServerSocket)
+
+
+def startGossip(station, udpServerSocket):
+    """
+    Start flooding timetable summaries, and again whenever the timetable changes
+    """
+    station.addTimetableListener(lambda changedDestinations: gossipTimetable(
+        station, udpServerSocket, changedDestinations))
+    gossipPeriodically(station, udpServerSocket)
+
+
+def serviceGossipMessage(station, msg, address, udpServerSocket):
+    """
+    Store the summaries in a gossip message that are newer than the topology database and flood them on
+    """
+    if station.topology == None:
+        return
+    newSummaries = [summary for summary in msg["summaries"]
+                    if station.topology.addSummary(summary)]
+    if len(newSummaries) > 0:
+        print(
+            f"Gossip from {address}: {[summary['stationName'] for summary in newSummaries]} updated. {len(station.topology)} stations known.")
+        sendGossip(station, udpServerSocket, newSummaries, tuple(address))
+
+
+def getMessageForNeighbour(msg, neighbour):
+    """
+    Get the message to send to a neighbour. The neighbour only needs this station's trip to it, so once the neighbour's
+    name is known the other earliest trips are left out. Returns None if there is no trip to the neighbour
+    """
+    if neighbour.stationName == "":
+        return msg
+    hopCount = msg["hopCount"]
+    stop = msg["route"][hopCount]
+    for trip in stop["earliestTrips"]:
+        if trip[4] == neighbour.stationName:
+            route = msg["route"][:hopCount] + [dict(stop, earliestTrips=[trip])] + msg["route"][hopCount + 1:]
+            return dict(msg, route=route)
+    return None
+
+
 def sendUdp(station, msg, udpServerSocket, messageSentLogs):
     """
     Send the message via UDP to the neighbours
     """
     neighbours = station.neighbours
-    msg_clean = json.dumps(msg)
-    message = msg_clean.encode(FORMAT)
+    encodings = {}  # the message encoded in each format
     sentToNeighbours = 0
     # print(f"Station: {station.stationName} | my neighbours are:\n")
     # send to each neighbour
@@ -407,10 +2314,14 @@ def sendUdp(station, msg, udpServerSocket, messageSentLogs):
             if str(route["stationUDPAddress"]) == str(neighbour.getStationUDPAddress()):
                 send = False
         # Don't send message to stations that a messageId already exists in the messageSentLogs (already sent to the neighbour)
-        for index, log in enumerate(messageSentLogs.logs):
-            if str(msg["messageId"]) == str(log.messageId) and str(neighbour.getStationUDPAddress()) == str(log.destinationStationAddress):
-                send = False
+        if messageSentLogs.hasLog(msg["messageId"], neighbour.getStationUDPAddress()):
+            send = False
         if send:
+            neighbourMsg = getMessageForNeighbour(msg, neighbour)
+            if neighbourMsg == None:
+                print(
+                    f"No trip to {neighbour.stationName}. Do not send message to {neighbour.udp_address}!")
+                continue
             # hopCount == 0 means that this is the source, so no parentAddress
             if msg["hopCount"] == 0:
                 # MessageId, parent, station, destination
@@ -421,7 +2332,12 @@ def sendUdp(station, msg, udpServerSocket, messageSentLogs):
                 newLog = MessageSentLog(
                     msg["route"][msg["hopCount"]]["messageId"], msg["route"][msg["hopCount"]-1]["stationUDPAddress"], station.getStationUDPAddress(), neighbour.getStationUDPAddress())
             messageSentLogs.addLog(newLog)
-            udpServerSocket.sendto(message, neighbour.udp_address)
+            if neighbourMsg is msg:
+                udpServerSocket.sendMessage(
+                    msg, neighbour.udp_address, encodings)
+            else:
+                udpServerSocket.sendMessage(
+                    neighbourMsg, neighbour.udp_address)
             sentToNeighbours = sentToNeighbours + 1
             print(
                 f"Station: {station.stationName} || sending message to: {neighbour.udp_address}")
@@ -447,14 +2363,11 @@ def getMessageToSend(requestObject, station, messageId):
             destination = item.get("to")
         if item.get("time") != None:
             time = str(item.get("time"))
-            time = urllib.parse.unquote(time)
         if item.get("tripType") != None:
             tripType = item.get("tripType")
     if time == "":
         timeObject = datetime.now().time()
-        hour = timeObject.hour
-        minute = timeObject.minute
-        time = f"{hour}:{minute}"
+        time = getTime(timeObject.hour * 60 + timeObject.minute)
     if tripType == "":
         tripType = "FastestTrip"
     message = Message(station.stationName,
@@ -462,11 +2375,10 @@ def getMessageToSend(requestObject, station, messageId):
                       tripType,
                       time,
                       messageId,
-                      messageType)
+                      messageType,
+                      station.queryTimeout)
     message.addRoute(station)
-    message = json.dumps(vars(message))  # return json object
-    message = json.loads(message)
-    return message
+    return dict(vars(message))
 
 
 def findDestination(station, msg):
@@ -488,46 +2400,203 @@ def sendUdpToParent(station, msg, udpServerSocket, hopCountDeduct):
     # print(f"Entering sendUdpToParent function")
     msg["messageType"] = "incoming"
     msg["hopCount"] = msg["hopCount"] - hopCountDeduct
-    # print(f"Dirty message at {station.stationName}: {msg}")
-    msg_clean = json.dumps(msg)
-    # print(f"Clean message at {station.stationName}: {msg_clean}")
-    message = msg_clean.encode(FORMAT)
-
     # get parent object from the route
     parent = msg["route"][msg["hopCount"]]
     # send to parent
     addressList = parent["stationUDPAddress"].strip("http://").split(":")
     addressTuple = (addressList[0], int(addressList[1]))
-    udpServerSocket.sendto(message, addressTuple)
+    udpServerSocket.sendMessage(msg, addressTuple)
     print(f"Incoming Message sent to parent: {addressTuple}")
 
 
-def sendResponseToClient(station, data, earliestTrip, sock, sel, stationResponse, routeEndFound, summarisedTrip):
+def getConnectionHeaders(data):
+    if data.keepAlive:
+        return f"Connection: keep-alive\r\nKeep-Alive: timeout={KEEP_ALIVE_TIMEOUT}\r\n"
+    return "Connection: close\r\n"
+
+
+def sendBadRequestToClient(station, data, error):
+    """
+    Answer a query that cannot be started with 400 Bad Request: the error in JSON to an API client, else the page
+    with the error in place of the trip
+    """
+    if data.api:
+        sendJsonToClient(data, {"error": error}, "400 Bad Request")
+        return
+    sendResponseToClient(station, data, [], "true", True, html.escape(f"Oh uh! {error[0].upper()}{error[1:]}."),
+                         "400 Bad Request")
+
+
+def sendResponseToClient(station, data, earliestTrip, stationResponse, routeEndFound, summarisedTrip,
+                         status="200 OK"):
     """
-    Send the response back to the client (Browser)
+    Send the response back to the client (Browser), or the route in JSON to an API client
     """
+    if data.api:
+        data.respondResult(getRouteResult(
+            station, data, earliestTrip, routeEndFound, summarisedTrip))
+        return False
     if routeEndFound == True:
         routeEndFound = "true"
     else:
         routeEndFound = "false"
-    sendData = "HTTP/1.1 200 OK\r\n"
-    sendData += "Content-Type: text/html; charset=utf-8\r\n"
-    sendData += "\r\n"
-    sendData += html_content.format(station=station.stationName,
-                                    timetable=station.timetable,
-                                    address=data.addr,
-                                    stationTcpAddress=station.getStationTCPAddress(),
-                                    tripTypes=TRIP_TYPE,
-                                    stationResponse=stationResponse,
-                                    responses=earliestTrip,
-                                    routeEndFound=routeEndFound,
-                                    summarisedTrip=summarisedTrip)
-    sock.send(sendData.encode())
-    sel.unregister(sock)
-    sock.close()
+    sendData = station.page.fill(stationResponse=stationResponse,
+                                 responses=earliestTrip,
+                                 routeEndFound=routeEndFound,
+                                 summarisedTrip=summarisedTrip)
+    response = f"HTTP/1.1 {status}\r\n"
+    response += "Content-Type: text/html; charset=utf-8\r\n"
+    response += f"Content-Length: {len(sendData)}\r\n"
+    response += getConnectionHeaders(data)
+    response += "\r\n"
+    data.respond(response.encode() + sendData)
     return False
 
 
+
+def getRouteResult(station, data, earliestTrip, routeEndFound, summarisedTrip):
+    """
+    Get the answer to an API client's query: its legs (as matchRoute leaves them), departure and arrival, the trip
+    summary and how many milliseconds the station took to answer
+    """
+    legs = [dict(zip(["from", "departure", "line", "stop", "arrival", "to"], leg))
+            for leg in earliestTrip if len(leg) == 6]
+    result = dict(data.query, found=not routeEndFound and len(legs) > 0)
+    if result["found"]:
+        result["departure"] = legs[0]["departure"]
+        result["arrival"] = legs[-1]["arrival"]
+        result["minutes"] = getMinutes(
+            legs[-1]["arrival"]) - getMinutes(legs[0]["departure"])
+    result["legs"] = legs
+    result["summary"] = summarisedTrip
+    result["elapsedMs"] = round((ts.monotonic() - data.started) * 1000, 3)
+    return result
+
+
+def sendJsonToClient(data, result, status="200 OK"):
+    """
+    Send the result to an API client as compact JSON, gzipped if the client accepts it and it is worth it
+    """
+    sendData = json.dumps(result, separators=(",", ":")).encode(FORMAT)
+    response = f"HTTP/1.1 {status}\r\n"
+    response += "Content-Type: application/json\r\n"
+    if data.acceptGzip and len(sendData) >= GZIP_MIN_SIZE:
+        sendData = gzip.compress(sendData)
+        response += "Content-Encoding: gzip\r\n"
+    response += "Vary: Accept-Encoding\r\n"
+    response += f"Content-Length: {len(sendData)}\r\n"
+    response += getConnectionHeaders(data)
+    response += "\r\n"
+    data.respond(response.encode() + sendData)
+
+
+class ClientBatch:
+    """
+    The queries of an /api/routes request. Each query is started as a request of its own, and the client is sent all
+    of their results once the last one is answered
+    """
+
+    def __init__(self, data, count):
+        self.data = data
+        self.results = [None] * count
+        self.remaining = count
+
+    def addResult(self, index, result):
+        self.results[index] = result
+        self.remaining = self.remaining - 1
+        if self.remaining == 0:
+            self.sendResults()
+
+    def sendResults(self):
+        """
+        Send the results to the client, null for the queries not answered yet (e.g. when the client times out)
+        """
+        sendJsonToClient(self.data, {"routes": self.results,
+                                     "elapsedMs": round((ts.monotonic() - self.data.started) * 1000, 3)})
+
+
+def getBatchRequestObjects(request):
+    """
+    Get the request object of each query of a batch request: a JSON list of {"to", "time", "tripType"} objects in the
+    body, or the query string with a "to" for each query followed by its "time" and "tripType" (a "time" or "tripType"
+    before the first "to" applies to every query).
+    Raises a ValueError if the request is malformed
+    """
+    if len(request.body) > 0:
+        queries = json.loads(request.body)
+        if not isinstance(queries, list) or not all(isinstance(query, dict) for query in queries):
+            raise ValueError("the body must be a list of objects")
+        requestObjects = [[{name: str(value)} for name, value in query.items() if name in ("to", "time", "tripType")]
+                          for query in queries]
+    else:
+        defaults = []
+        requestObjects = []
+        for item in getRequestObject(request.query):
+            if "to" in item:
+                requestObjects.append(list(defaults))
+            (requestObjects[-1] if len(requestObjects) > 0 else defaults).append(item)
+    if not all(any(item.get("to") for item in requestObject) for requestObject in requestObjects):
+        raise ValueError("every query needs a destination (to)")
+    # all queries are checked before any of them is started
+    for requestObject in requestObjects:
+        checkRequestObject(requestObject)
+    if len(requestObjects) > MAX_BATCH_QUERIES:
+        raise ValueError(f"at most {MAX_BATCH_QUERIES} queries are answered at once")
+    return requestObjects
+
+
+def serviceBatchRequest(request, sock, data, station, udpServerSocket, messageSentLogs, clientRequestLogs, messageBank):
+    """
+    Start all queries of an /api/routes request at once, so they are answered concurrently
+    """
+    try:
+        requestObjects = getBatchRequestObjects(request)
+    except ValueError as exception:
+        sendJsonToClient(data, {"error": str(exception)}, "400 Bad Request")
+        return
+    batch = ClientBatch(data, len(requestObjects))
+    # if the client gives up waiting, it is sent the results so far
+    data.query = {}
+    data.respondResult = lambda result: batch.sendResults()
+    # the queries are detached by their keys when the connection closes (see ClientRequestLogs.removeConnection)
+    data.batchKeys = [(sock, index) for index in range(len(requestObjects))]
+    if len(requestObjects) == 0:
+        batch.sendResults()
+        return
+    for index, requestObject in enumerate(requestObjects):
+        # each query waits on its own request log, as if it came from a client of its own
+        queryData = types.SimpleNamespace(addr=data.addr, api=True, started=data.started,
+                                          respondResult=lambda result, index=index: batch.addResult(index, result))
+        startClientQuery(requestObject, (sock, index), queryData, station, udpServerSocket,
+                         messageSentLogs, clientRequestLogs, messageBank)
+
+
+def sendLandingPageToClient(station, data, request):
+    """
+    Send the page without a route result, or 304 Not Modified if the client has the current one cached
+    """
+    landingPage, etag = station.page.getLandingPage()
+    ifNoneMatch = request.headers.get("if-none-match", "")
+    cachedTags = [tag.strip().replace("W/", "", 1)
+                  for tag in ifNoneMatch.split(",")]
+    if etag in cachedTags or ifNoneMatch.strip() == "*":
+        response = "HTTP/1.1 304 Not Modified\r\n"
+        response += f"ETag: {etag}\r\n"
+        response += getConnectionHeaders(data)
+        response += "\r\n"
+        data.respond(response.encode())
+        return
+    response = "HTTP/1.1 200 OK\r\n"
+    response += "Content-Type: text/html; charset=utf-8\r\n"
+    response += f"Content-Length: {len(landingPage)}\r\n"
+    # browsers check the page is still current before using their copy
+    response += f"ETag: {etag}\r\n"
+    response += "Cache-Control: no-cache\r\n"
+    response += getConnectionHeaders(data)
+    response += "\r\n"
+    data.respond(response.encode() + landingPage)
+
+
 def getSummarisedTrip(msg):
     """
     Get a summarised one-liner trip details that can be displayed at the top of the browser.
@@ -543,69 +2612,188 @@ def getSummarisedTrip(msg):
     return summarisedTrip
 
 
-def serviceTcpConnection(key, mask, sel, station, udpServerSocket, messageSentLogs, clientRequestLogs):
+def getTripOptions(msg):
+    """
+    Describe the transfers of the trip for LeastTransfers, and the other routes found for ParetoTrip, to add to the
+    summarised trip. Must be called before the station names are added to the trips
+    """
+    if msg["tripType"] == "FastestTrip":
+        return ""
+    legs = getRouteLegs(msg["route"], msg["destinationName"])
+    tripOptions = f" This trip has {getTransfers(legs)} transfers."
+    for route in msg.get("paretoRoutes", []):
+        legs = getRouteLegs(route, msg["destinationName"])
+        tripOptions += f" Or depart at {legs[0][0]} taking {legs[0][1]} and arrive at {legs[-1][3]} with {getTransfers(legs)} transfers."
+    return tripOptions
+
+
+def serviceClientRequest(request, sock, data, station, udpServerSocket, messageSentLogs, clientRequestLogs, messageBank):
+    """
+    Service a request from the client - respond straight away or send the message to the neighbours.
+    request is the HttpRequest. Requests to /api/route are answered with the route in JSON instead of the page, and
+    requests to /api/routes with the routes of several queries at once (see getBatchRequestObjects)
+    """
+    requestObject = getRequestObject(request.query)
+    data.started = ts.monotonic()
+    data.api = request.path.startswith("/api/")
+    data.acceptGzip = request.acceptsEncoding("gzip")
+
+    if request.path == "/api/routes":
+        serviceBatchRequest(request, sock, data, station, udpServerSocket,
+                            messageSentLogs, clientRequestLogs, messageBank)
+    elif data.api and request.path != "/api/route":
+        sendJsonToClient(
+            data, {"error": f"unknown endpoint {request.path}"}, "404 Not Found")
+    elif any(item.get("to") for item in requestObject):
+        try:
+            checkRequestObject(requestObject)
+        except ValueError as exception:
+            sendBadRequestToClient(station, data, str(exception))
+            return
+        if data.api:
+            data.respondResult = lambda result: sendJsonToClient(data, result)
+        startClientQuery(requestObject, sock, data, station, udpServerSocket,
+                         messageSentLogs, clientRequestLogs, messageBank)
+    elif data.api:
+        sendJsonToClient(
+            data, {"error": "the destination (to) is missing"}, "400 Bad Request")
+    else:
+        sendLandingPageToClient(station, data, request)
+
+
+def startClientQuery(requestObject, sock, data, station, udpServerSocket, messageSentLogs, clientRequestLogs, messageBank):
+    """
+    Start the query of a request: answer it straight away (from the timetable, the route cache or the gossiped
+    timetables), wait on an identical query in flight, or send the message to the neighbours
+    """
+    # Request has been received!
+    # Create message
+    messageId = uuid.uuid1().int
+    print(
+        f"StationName: {station.stationName} || Message ID: {messageId}")
+    # get message to send and append station to message route and set hopCount to 0
+    msg = getMessageToSend(requestObject, station, messageId)
+    print(f"initial message: {msg}")
+    data.query = {"to": msg["destinationName"],
+                  "time": msg["time"], "tripType": msg["tripType"]}
+    coalescedLog = clientRequestLogs.attach(msg, sock, data)
+    if coalescedLog != None:
+        # an identical query is in flight, so wait for its answer instead of sending another one
+        print(
+            f"Station: {station.stationName}. Waiting on the query in flight with Message ID {coalescedLog.msg['messageId']} ({len(coalescedLog.clients)} clients).")
+        return
+    clientRequestLog = ClientRequestLog(
+        msg, sock, data)
+    clientRequestLogs.addLog(clientRequestLog)
+    destFound, earliestTrip = findDestination(station, msg)
+    print(f"find dest message: {msg}")
+    if destFound:
+        # if destination is found, then send message back to client
+        msg = matchRoute(msg)
+        print(f"match route msg: {msg}")
+        tripOptions = getTripOptions(msg)
+        earliestTrip.insert(0, station.stationName)
+        print(f"earliest trip msg: {msg}")
+        summarisedTrip = getSummarisedTrip(msg) + tripOptions
+        print(f"summarised trip: {summarisedTrip}")
+        clientRequestLogs.removeLog(msg)
+        sendResponseToClient(
+            station, data, [earliestTrip], "true", False, summarisedTrip)
+    routedMessage = None
+    if not destFound:
+        # the same query may have been answered recently
+        routedMessage = station.routeCache.get(msg)
+        if routedMessage != None:
+            print(
+                f"Station: {station.stationName}. Answering from the route cache. {station.routeCache.counters}")
+    if routedMessage == None and not destFound and station.topology != None:
+        # gossip routing: find the route in the gossiped timetables instead of flooding the query
+        routedMessage = station.topology.findRoute(msg)
+        if routedMessage != None:
+            print(
+                f"Station: {station.stationName}. Route found from the timetables of {len(station.topology) + 1} stations.")
+    if routedMessage != None:
+        respondWithCollatedMessage(
+            station, routedMessage, clientRequestLogs)
+    elif not destFound:
+        # if destination is not found, then pass message forward to other nodes
+        print(
+            f"Station: {station.stationName}. Servicing TCP Request. Sending UDP.")
+        sentToNeighbours = sendUdp(station, msg,
+                                   udpServerSocket, messageSentLogs)
+        if sentToNeighbours == False:
+            # no neighbours to ask, so there is no route
+            clientRequestLogs.removeLog(msg)
+            sendResponseToClient(
+                station, data, [], "true", True, "Oh uh! No route found!")
+        else:
+            startHopDeadline(station, msg, udpServerSocket,
+                             messageSentLogs, clientRequestLogs, messageBank)
+
+
+def serviceTcpConnection(key, mask, sel, station, udpServerSocket, messageSentLogs, clientRequestLogs, messageBank):
     """
-    Service the TCP Connection - accept, read
+    Service the TCP Connection. Each connection goes through the states:
+    reading (until a request is parsed) -> waiting (for the UDP communication) -> writing (the response) -> closed,
+    or back to reading for the next request if the connection is kept alive
     """
-    request = False
-    method = "GET"
     sock = key.fileobj
     data = key.data
     # if the socket is ready for reading -- mask is True & selectors.EVENT_READ is True
     if mask & selectors.EVENT_READ:
         # receive the data
-        recv_data = sock.recv(1024).decode(FORMAT)
-        if recv_data:  # if recv_data is not None
-            request = True
-            method = recv_data.split()[0]
-            requestBody = getRequestBody(recv_data.split("\r\n"))
-            if "to" in requestBody:
-                # Request has been received!
-                requestObject = getRequestObject(requestBody)
-                # Create message
-                messageId = uuid.uuid1().int
-                print(
-                    f"StationName: {station.stationName} || Message ID: {messageId}")
-                # get message to send and append station to message route and set hopCount to 0
-                msg = getMessageToSend(requestObject, station, messageId)
-                print(f"initial message: {msg}")
-                clientRequestLog = ClientRequestLog(
-                    msg, sock, sel, data)
-                clientRequestLogs.addLog(clientRequestLog)
-                destFound, earliestTrip = findDestination(station, msg)
-                print(f"find dest message: {msg}")
-                if destFound:
-                    # if destination is found, then send message back to client
-                    msg = matchRoute(msg)
-                    print(f"match route msg: {msg}")
-                    earliestTrip.insert(0, station.stationName)
-                    print(f"earliest trip msg: {msg}")
-                    summarisedTrip = getSummarisedTrip(msg)
-                    print(f"summarised trip: {summarisedTrip}")
-                    request = sendResponseToClient(
-                        station, data, [earliestTrip], sock, sel, "true", False, summarisedTrip)
-                    clientRequestLogs.removeLog(msg)
-                if not destFound:
-                    # if destination is not found, then pass message forward to other nodes
-                    print(
-                        f"Station: {station.stationName}. Servicing TCP Request. Sending UDP.")
-                    sendUdp(station, msg,
-                            udpServerSocket, messageSentLogs)
-
-        else:  # the client has closed their socket so the server should too.
-            print('closing connection to', data.addr)
-            sel.unregister(sock)
-            sock.close()
+        recv_data = sock.recv(TCP_RECV_SIZE)
+        data.lastRead = ts.monotonic()
+        if not recv_data:  # the client has closed their socket so the server should too.
+            closeTcpConnection(sock, sel, data, clientRequestLogs)
+            return
+        # a request sent while the last one is still being answered waits in the parser
+        try:
+            data.parser.feed(recv_data)
+        except RequestTooLarge as exception:
+            print(f"Closing the connection to {data.addr}: {exception}")
+            closeTcpConnection(sock, sel, data, clientRequestLogs)
+            return
+        if data.state == "reading":
+            serviceNextHttpRequest(sock, data, station, udpServerSocket,
+                                   messageSentLogs, clientRequestLogs, messageBank)
     if mask & selectors.EVENT_WRITE:  # write the data back to the client
-        # we have received, and now we can send
-        if request:
-            send = True
-            for log in clientRequestLogs.logs:
-                if log.sock == sock:
-                    send = False
-            if send:
-                request = sendResponseToClient(
-                    station, data, [[]], sock, sel, "false", False, "")
+        # the socket may not take the whole response at once
+        sent = sock.send(data.outb)
+        data.outb = data.outb[sent:]
+        if not data.outb:
+            if not data.keepAlive:
+                closeTcpConnection(sock, sel, data, clientRequestLogs)
+                return
+            data.state = "reading"
+            sel.modify(sock, selectors.EVENT_READ, data=data)
+            # the connection is idle from when it was answered
+            data.lastRead = ts.monotonic()
+            startIdleTimer(station, sock, sel, data, clientRequestLogs)
+            serviceNextHttpRequest(sock, data, station, udpServerSocket,
+                                   messageSentLogs, clientRequestLogs, messageBank)
+
+
+def serviceNextHttpRequest(sock, data, station, udpServerSocket, messageSentLogs, clientRequestLogs, messageBank):
+    """
+    Service the next request of the connection if all of it has been received. A malformed request is answered with
+    400 Bad Request (413 Payload Too Large if its body is too large) and the connection closed
+    """
+    try:
+        request = data.parser.getRequest()
+    except ValueError as exception:
+        print(f"Bad request from {data.addr}: {exception}")
+        data.state = "waiting"
+        data.keepAlive = False
+        data.respond(getHttpErrorResponse(getBadRequestStatus(exception)))
+        return
+    if request == None:
+        return
+    data.state = "waiting"
+    data.requests += 1
+    data.keepAlive = request.keepAlive
+    serviceClientRequest(request, sock, data, station,
+                         udpServerSocket, messageSentLogs, clientRequestLogs, messageBank)
 
 
 def startTcpPort(station, sel):
@@ -614,6 +2802,8 @@ def startTcpPort(station, sel):
     """
     # create TCP server socket
     tcpServerSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # a restarted station can listen again while its old connections are in TIME_WAIT (as asyncio.start_server does)
+    tcpServerSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     tcpServerSocket.bind(station.tcp_address)
     tcpServerSocket.listen()
     print(f"[LISTENING] TCP Server is listening on {station.tcp_address}.")
@@ -629,6 +2819,8 @@ def startUdpPort(station, sel):
     # create UDP server socket
     udpServerSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     udpServerSocket.bind(station.udp_address)
+    if station.udpBufferSize != None:
+        setUdpBufferSize(udpServerSocket, station.udpBufferSize)
     print(f"[LISTENING] UDP Server is listening on {station.udp_address}.")
     # udpServerSocket.setblocking(False)
     sel.register(udpServerSocket, selectors.EVENT_READ, data=None)
@@ -650,13 +2842,68 @@ def removeNonDestination(message, station):
     return message
 
 
-def addStationToRoute(message, station, messageId):
+def getLegToStation(message, station):
     """
-    Add the current station to the route
+    Get the parent's trip to this station
     """
     for trip in message["route"][message["hopCount"]]["earliestTrips"]:
         if trip[4] == station.stationName:
-            lastRouteTime = trip[3]
+            return trip
+    return None
+
+
+def getOnwardTrips(station, time, withLines):
+    """
+    Get the (destination, arrival) of the earliest trip to each destination departing at or after the time, with the
+    line if withLines. A station takes the first departure to each destination, not the fastest one, so a later
+    arrival is only no better if it leads to no other trips (in a timetable where a later departure can arrive earlier)
+    """
+    if withLines:
+        return frozenset((trip[4], trip[3], trip[1]) for trip in station.getEarliestTrips(time))
+    return frozenset((trip[4], trip[3]) for trip in station.getEarliestTrips(time))
+
+
+def getDominatingRoute(station, msg):
+    """
+    Check if another message of the query arrived at this station at least as well as this one, else record its
+    arrival. A branch is pruned if another one arrived no later and takes every onward trip this one would take (see
+    getOnwardTrips), so the flood sends the other branch on every trip it would have sent this one on. Arriving no
+    later is not enough by itself: a station takes the first departure to each destination, and in a timetable where
+    a later departure can arrive earlier the earlier arrival may miss it. For the other trip types the other branch
+    must also have no more transfers (a multi-criteria label search).
+    Returns the route (station names) of the branch that did better, or None if there is none or pruning is off.
+    """
+    if not station.prune:
+        return None
+    leg = getLegToStation(msg, station)
+    arrival = getMinutes(leg[3])
+    lifetime = float(msg.get("queryTimeout") or station.queryTimeout)
+    route = [stop["stationName"] for stop in msg["route"][:msg["hopCount"] + 1]]
+    if msg["tripType"] == "FastestTrip":
+        return station.arrivalLabels.recordNonDominated(msg["messageId"], (arrival, 0, None),
+                                                        getOnwardTrips(station, leg[3], False), lifetime, route)
+    legs = getRouteLegs(msg["route"][:msg["hopCount"] + 1], station.stationName)
+    return station.arrivalLabels.recordNonDominated(msg["messageId"], (arrival, getTransfers(legs), leg[1]),
+                                                    getOnwardTrips(station, leg[3], True), lifetime, route)
+
+
+def getCommonPrefixLength(route, otherRoute):
+    length = 0
+    for stationName, otherStationName in zip(route, otherRoute):
+        if stationName != otherStationName:
+            break
+        length = length + 1
+    return length
+
+
+def addStationToRoute(message, station, messageId):
+    """
+    Add the current station to the route
+    """
+    leg = getLegToStation(message, station)
+    lastRouteTime = leg[3]
+    # from here on the parent only needs to carry the leg it took to this station
+    message["route"][message["hopCount"]]["earliestTrips"] = [leg]
     stationObject = station.getStationObject(messageId, lastRouteTime)
     message["route"].append(stationObject)
     message["hopCount"] = message["hopCount"] + 1
@@ -669,48 +2916,38 @@ def collateMessages(msg, messageBank):
     Else return the original message but set routeEndFound = True (in case). 
     """
     earliestMessage = None
-    tripType = msg["tripType"]
     hopCount = msg["hopCount"]
     messageId = msg["route"][hopCount]["messageId"]
     destinationName = msg["destinationName"]
 
-    if tripType == "FastestTrip":
-        # just grab one record to set as the initial earliest time
-        for message in messageBank.bank:
-            try:
-                if message["routeEndFound"] == False and message["route"][hopCount]["messageId"] == messageId:
-                    # grab matching route
-                    earliestTime = message["route"][-1]["earliestTrips"][0][3]
-                    earliestMessage = message
-                    break
-            except:
-                pass  # the message is some other message that doesn't have the same hopCount
-        # always grab the latest one (to destination) if looking for fastests trip
-        for message in messageBank.bank:
-            try:
-                if message["routeEndFound"] == False and \
-                    len(message["route"][-1]["earliestTrips"]) > 0 and \
-                        message["route"][hopCount]["messageId"] == messageId:
-                    # grab last route
-                    compareEarliestTime = message["route"][-1]["earliestTrips"][0][3]
-                    if compareEarliestTime < earliestTime:
-                        earliestTime = compareEarliestTime
-                        earliestMessage = message
-            except:
-                pass  # the message is some other message that doesn't have the same hopCount
+    # the message bank has kept the best message for the trip type (e.g. the earliest arrival to the destination)
+    print(
+        f'Removing message id from messageBank: {messageId}')
+    # Remove the messages from the messageBank with the matching message id
+    incomplete = messageBank.removeIncomplete(messageId)
+    earliestMessage = messageBank.removeMessage(messageId)
 
-        print(
-            f'Removing message id from messageBank: {messageId}')
-        # Remove all messages from the messageBank with the matching message id
-        messageBank.removeMessage(hopCount, messageId)
 
-        # if earliestMessage contains an object, then return the earliestMessage. Else return the original message but set routeEndFound = True.
-        if earliestMessage != None:
-            return earliestMessage
-        else:
-            msg["routeEndFound"] = True
-            msg["messageType"] = "incoming"
-            return msg
+    # if earliestMessage contains an object, then return the earliestMessage. Else return the original message but set routeEndFound = True.
+    if earliestMessage == None:
+        earliestMessage = msg
+        earliestMessage["routeEndFound"] = True
+        earliestMessage["messageType"] = "incoming"
+    # the collated message is as incomplete as the most incomplete of the replies it was chosen from
+    earliestMessage.pop("incomplete", None)
+    if incomplete != None:
+        earliestMessage["incomplete"] = incomplete
+    return earliestMessage
+
+
+def isCompleteAt(msg, hopCount):
+    """
+    Check if the routes of a collated message are the best ones from the station at route[hopCount] for any query
+    arriving there as this one did. A message's "incomplete" field is the depth of the route up to which it is: the
+    stations before it shared their route with every branch of the query that was left out (0 when a reply was missed)
+    """
+    incomplete = msg.get("incomplete")
+    return incomplete == None or incomplete > hopCount
 
 
 def removeVisitedFromEarliestTrips(msg):
@@ -773,126 +3010,181 @@ def findRoutePosition(route, stationName):
             return index
 
 
+def respondWithCollatedMessage(station, collatedMessage, clientRequestLogs):
+    """
+    Return the webpage with the trip details of the collated message to the client (this is the source station)
+    """
+    print(f"Collated Message is: {collatedMessage}")
+    earliestTrips = []
+    routeEndFound = collatedMessage["routeEndFound"]
+    if not routeEndFound:
+        tripOptions = getTripOptions(collatedMessage)
+        for route in collatedMessage["route"]:
+            route["earliestTrips"][0].insert(0,
+                                             route["stationName"])
+            earliestTrips.append(route["earliestTrips"][0])
+        # get summarised trip
+        summarisedTrip = getSummarisedTrip(collatedMessage) + tripOptions
+    if routeEndFound:
+        # set summarised trip to not found message
+        summarisedTrip = "Oh uh! No route found!"
+
+    clientLog = clientRequestLogs.getLog(
+        collatedMessage)
+    if clientLog == None:
+        print("The client has closed the connection. Dropping the response.")
+    else:
+        clientRequestLogs.removeLog(collatedMessage)
+
+        for data in clientLog.clients.values():
+            sendResponseToClient(
+                station, data, earliestTrips, "true", routeEndFound, summarisedTrip)
+
+
+def completeHop(station, msg, udpServerSocket, messageSentLogs, clientRequestLogs, messageBank, expired=False):
+    """
+    All replies to this station's hop have returned (or its deadline has passed). Collate the messages from the message bank
+    and respond to the client if this is the source, else send the best message back to the parent.
+    msg is any message whose route[hopCount] is this station
+    """
+    messageSentLogs.cancelDeadline(msg["route"][msg["hopCount"]]["messageId"])
+    collatedMessage = collateMessages(msg, messageBank)
+    collatedMessage = matchRoute(collatedMessage)
+    if expired:
+        collatedMessage["incomplete"] = 0
+    if msg["sourceName"] == station.stationName:
+        if isCompleteAt(collatedMessage, 0):
+            # an answer missing replies may not be the best one, so it is not kept
+            station.routeCache.add(collatedMessage)
+        respondWithCollatedMessage(station, collatedMessage, clientRequestLogs)
+        print(f"UDP counters: {udpServerSocket.getCounters()}")
+    else:
+        station.subRouteCache.add(collatedMessage)
+        print("Begin sending message back to parent.")
+        sendUdpToParent(station, collatedMessage,
+                        udpServerSocket, 1)
+        print(
+            f"station: {station.stationName} || Message sent to parent successfully. now awaiting {len(messageSentLogs)} other messages.")
+
+
+def getHopTimeout(station, msg):
+    """
+    Get how long this station's hop waits for replies. Each hop waits HOP_TIMEOUT_MARGIN less than its parent,
+    so the replies of deeper hops get back before the hops above them give up.
+    """
+    queryTimeout = float(msg.get("queryTimeout") or station.queryTimeout)
+    return max(queryTimeout - HOP_TIMEOUT_MARGIN * msg["hopCount"], MIN_HOP_TIMEOUT)
+
+
+def startHopDeadline(station, msg, udpServerSocket, messageSentLogs, clientRequestLogs, messageBank):
+    """
+    Schedule the deadline for the replies to the message this station has just sent to its neighbours
+    """
+    messageId = msg["route"][msg["hopCount"]]["messageId"]
+    timer = station.timers.call_later(getHopTimeout(station, msg), expireHop, station, msg,
+                                      udpServerSocket, messageSentLogs, clientRequestLogs, messageBank)
+    messageSentLogs.setDeadline(messageId, timer)
+
+
+def expireHop(station, msg, udpServerSocket, messageSentLogs, clientRequestLogs, messageBank):
+    """
+    The deadline of this station's hop has passed. Stop waiting for the missing replies and send on the best result so far.
+    """
+    messageId = msg["route"][msg["hopCount"]]["messageId"]
+    missingLogs = messageSentLogs.removeLogs(messageId)
+    if len(missingLogs) == 0:
+        return
+    print(
+        f"Deadline passed for messageId: {messageId}. No reply from {[log.destinationStationAddress for log in missingLogs]}. Sending the best result so far.")
+    completeHop(station, msg, udpServerSocket,
+                messageSentLogs, clientRequestLogs, messageBank, True)
+
+
 def serviceUdpCommunication(key, mask, sel, station, udpServerSocket, messageSentLogs, clientRequestLogs, messageBank):
     """
-    Service the UDP communication - send, recv
+    Service the UDP communication - recv from the socket registered with the selector.
+    udpServerSocket is the ReliableUdpTransport wrapping it
+    """
+    try:
+        bytesAddressPair = key.fileobj.recvfrom(
+            station.MessageSize)
+    except OSError as exception:
+        # e.g. an ICMP port unreachable from a neighbour that is down
+        print(f"UDP error: {exception}")
+        return
+    serviceUdpMessage(bytesAddressPair[0], bytesAddressPair[1], station,
+                      udpServerSocket, messageSentLogs, clientRequestLogs, messageBank)
+
+
+def serviceUdpMessage(datagram, address, station, udpServerSocket, messageSentLogs, clientRequestLogs, messageBank):
+    """
+    Service a datagram from another station - each message it carries (none for an ACK or a duplicate)
+    udpServerSocket is the ReliableUdpTransport
     """
-    bytesAddressPair = udpServerSocket.recvfrom(
-        station.MessageSize)
-    message = bytesAddressPair[0].decode()
-    msg = json.loads(message)  # load msg
+    for message in udpServerSocket.receive(datagram, address):
+        serviceStationMessage(message, address, station, udpServerSocket,
+                              messageSentLogs, clientRequestLogs, messageBank)
+
+
+def serviceStationMessage(datagram, address, station, udpServerSocket, messageSentLogs, clientRequestLogs, messageBank):
+    """
+    Service a message from another station - send
+    """
+    try:
+        msg = decodeMessage(datagram)  # load msg
+    except ValueError as exception:
+        # e.g. a message from a Java station that did not fit in one datagram
+        print(
+            f"Dropping a message from {address} that could not be decoded ({len(datagram)} bytes): {exception}")
+        return
+    newCapabilities = udpServerSocket.addPeerCapabilities(
+        address, msg.get("capabilities"))
+    if station.topology != None and "gossip" in newCapabilities:
+        # the neighbour has just started gossip routing, so bring it up to date
+        udpServerSocket.sendto(getGossipMessage(
+            station, station.topology.getSummaries()), address)
+    if msg["messageType"] == "gossip":
+        serviceGossipMessage(station, msg, address, udpServerSocket)
+        return
+    station.learnNeighbourNames(msg["route"])
+    station.routeCache.learnVersions(msg["route"])
+    if msg["messageType"] == "incoming" and msg["destinationName"] == "":
+        # the reply to a probe only tells us the neighbour's capabilities
+        return
 
-    address = bytesAddressPair[1]
-    destinationMsg = f"Message from Client:{message}"
-    destinationIP = f"Destination IP Address:{address}"
     print(f"\n\nMessage received from {address}")
-    print(f"Message from {address}: {message}")
+    print(f"Message from {address}: {msg}")
     # message is incoming
     if msg["messageType"] == "incoming":
         print(f"Message type: incoming")
-        # print(f"message received:{message}")
-        # print(f"Source Station(message): {msg['sourceName']}")
-        # print(f"Current station: {station.stationName}")
+        destinationStationAddress = f"http://{address[0]}:{address[1]}"
+        removeMessageId = msg["route"][msg["hopCount"]]["messageId"]
         # check if I am the source
         if msg["sourceName"] == station.stationName:
-            # add message to message bank and remove from MessageSentLog
             print("message received!. i am the source.")
-            messageBank.addMessage(msg)
-            destinationStationAddress = f"http://{address[0]}:{address[1]}"
-            removeMessageId = msg["route"][msg["hopCount"]]["messageId"]
             parentAddress = ""  # no parent address as this is the source
-            print(
-                f"attempting to remove messageId: {removeMessageId} || parentAddress: {parentAddress} || destinationStationAddress: {destinationStationAddress}")
-            removedLog = messageSentLogs.removeLog(
-                parentAddress, destinationStationAddress, removeMessageId)
-            if removedLog == None:
-                print(
-                    f"Attempting to remove from message sent logs:")
-                for index, log in enumerate(messageSentLogs.logs):
-                    print(
-                        f"index: {index} || log: {vars(log)}")
-                print("\n")
-
-                raise Exception(
-                    f"@@@@@@@@ SOURCE @@@@@@@@@ Failed to remove messageId: {removeMessageId} || parentAddress: {parentAddress} || destinationStationAddress: {destinationStationAddress}")
-            print(f"Removal successful.")
-
-            if messageSentLogs.getLogs(removedLog.messageId) == None:
-                # return webpage with trip details
-                collatedMessage = collateMessages(msg, messageBank)
-                collatedMessage = matchRoute(collatedMessage)
-                print(f"Collated Message is: {collatedMessage}")
-                earliestTrips = []
-                routeEndFound = collatedMessage["routeEndFound"]
-                if not routeEndFound:
-                    for route in collatedMessage["route"]:
-                        route["earliestTrips"][0].insert(0,
-                                                         route["stationName"])
-                        earliestTrips.append(route["earliestTrips"][0])
-                    # get summarised trip
-                    summarisedTrip = getSummarisedTrip(collatedMessage)
-                if routeEndFound:
-                    # set summarised trip to not found message
-                    summarisedTrip = "Oh uh! No route found!"
-
-                clientLog = clientRequestLogs.getLog(
-                    collatedMessage)
-                sendResponseToClient(
-                    station, clientLog.data, earliestTrips, clientLog.sock, clientLog.sel, "true", routeEndFound, summarisedTrip)
-                removedClientLogs = clientRequestLogs.removeLog(
-                    collatedMessage)
         else:
-            # add message to message bank and remove from MessageSentLog
-            messageBank.addMessage(msg)
-            # print(f"Current Message Logs:\n")
-            # for index, log in enumerate(messageSentLogs.logs):
-            #     print(f"Index: {index} || Message: {vars(log)}")
-            destinationStationAddress = f"http://{address[0]}:{address[1]}"
-            removeMessageId = msg["route"][msg["hopCount"]]["messageId"]
             parentAddress = msg["route"][findRoutePosition(
                 msg["route"], station.stationName) - 1]["stationUDPAddress"]
+        # remove from MessageSentLog and add message to message bank
+        print(
+            f"attempting to remove messageId: {removeMessageId} || parentAddress: {parentAddress} || destinationStationAddress: {destinationStationAddress}")
+        removedLog = messageSentLogs.removeLog(
+            parentAddress, destinationStationAddress, removeMessageId)
+        if removedLog == None:
+            # the hop's deadline has already passed and it was answered without this message
             print(
-                f"attempting to remove messageId: {removeMessageId} || parentAddress: {parentAddress} || destinationStationAddress: {destinationStationAddress}")
-            removedLog = messageSentLogs.removeLog(
-                parentAddress, destinationStationAddress, removeMessageId)
-            if removedLog == None:
-                print(
-                    f"Attempting to remove from message sent logs:")
-                for index, log in enumerate(messageSentLogs.logs):
-                    print(
-                        f"index: {index} || log: {vars(log)}")
-                print("\n")
-                raise Exception(
-                    f"@@@@@@@ STATION @@@@@@@ Failed to remove messageId: {removeMessageId} || parentAddress: {parentAddress} || destinationStationAddress: {destinationStationAddress} \
-                        from {' '.join(map(str,messageSentLogs.logs))}")
-            print(f"Removal successful.")
-            # print(
-            #     f"station: {station.stationName} || Removed Log: {vars(removedLog)}")
-            # if messageSentLog for message is empty, then collate messages from message bank and send back to parent
-            if messageSentLogs.getLogs(removedLog.messageId) == None:
-                # print("That's all folks!")
-                print("Begin sending message back to parent.")
-                collatedMessage = collateMessages(msg, messageBank)
-                collatedMessage = matchRoute(collatedMessage)
-                # for index, message in enumerate(messageBank.bank):
-                #     print(
-                #         f"Station: {station.stationName} || Message Bank Index:{index} || Message: {message} ")
-                # print("Calling send udp parent function")
-                sendUdpToParent(station, collatedMessage,
-                                udpServerSocket, 1)
-                print(
-                    f"station: {station.stationName} || Message sent to parent successfully. now awaiting the following other messages:")
-                for index, log in enumerate(messageSentLogs.logs):
-                    print(
-                        f"station: {station.stationName} || index: {index} || log: {vars(log)}")
-                print("\n")
-            else:
-                print(
-                    f"Message removed. Waiting on other messages to return. Messages left:")
-                for index, log in enumerate(messageSentLogs.getLogs(removedLog.messageId)):
-                    print(
-                        f"index: {index} || log: {vars(log)}")
-                print("\n")
+                f"No message sent log for messageId: {removeMessageId} || destinationStationAddress: {destinationStationAddress}. The reply is late, dropping it.")
+            return
+        print(f"Removal successful.")
+        messageBank.addMessage(msg)
+        # if messageSentLog for message is empty, then collate messages from message bank
+        if not messageSentLogs.hasLogs(removedLog.messageId):
+            completeHop(station, msg, udpServerSocket,
+                        messageSentLogs, clientRequestLogs, messageBank)
+        else:
+            print(
+                f"Message removed. Waiting on {len(messageSentLogs.getLogs(removedLog.messageId))} other messages to return.")
 
     # message is outgoing
     else:
@@ -905,8 +3197,21 @@ def serviceUdpCommunication(key, mask, sel, station, udpServerSocket, messageSen
         else:
             messageIntended = checkStationInEarliestTrips(msg, station)
             print(f"This message was intended for me: {messageIntended}")
-            # only perform actions if the message was intended for the station
+            dominatingRoute = None
             if messageIntended:
+                dominatingRoute = getDominatingRoute(station, msg)
+            if dominatingRoute != None:
+                # another branch of the query got here no later and takes all the trips this one would take on
+                print(
+                    "An arrival at this station at least as good is already known for this query. Pruning this branch.")
+                msg["routeEndFound"] = True
+                # the best route from here is left to the other branch, so the answers of the stations this branch
+                # does not share with it are only right for this query
+                msg["incomplete"] = getCommonPrefixLength(
+                    [stop["stationName"] for stop in msg["route"][:msg["hopCount"] + 1]], dominatingRoute)
+                sendUdpToParent(station, msg, udpServerSocket, 0)
+            # only perform actions if the message was intended for the station
+            elif messageIntended:
                 # add station to route
                 messageId = uuid.uuid1().int
                 print(f"Generated message messageId: {messageId}")
@@ -926,13 +3231,24 @@ def serviceUdpCommunication(key, mask, sel, station, udpServerSocket, messageSen
                     parent = msg["route"][msg["hopCount"]]
                     print(f"message sent to parent. {parent}")
                 # if station does not contain route to destination, then send to neighbours (outgoing)
+                cachedMessage = None
                 if destFound == False and routeEndFound == False:
+                    cachedMessage = station.subRouteCache.get(msg)
+                if cachedMessage != None:
+                    print(
+                        f"Onward route found in the sub-route cache. Sending to parent. {station.subRouteCache.counters}")
+                    sendUdpToParent(station, cachedMessage,
+                                    udpServerSocket, 1)
+                elif destFound == False and routeEndFound == False:
                     sentToNeighbours = sendUdp(station, msg,
                                                udpServerSocket, messageSentLogs)
                     if sentToNeighbours == False:
                         # exhausted all means, send back to parent
                         msg["routeEndFound"] = True
                         sendUdpToParent(station, msg, udpServerSocket, 1)
+                    else:
+                        startHopDeadline(station, msg, udpServerSocket,
+                                         messageSentLogs, clientRequestLogs, messageBank)
                 # found a dead end, send message back to parent
                 if destFound == False and routeEndFound == True:
                     print("dead end found! sending back to parent")
@@ -944,11 +3260,11 @@ def serviceUdpCommunication(key, mask, sel, station, udpServerSocket, messageSen
                 sendUdpToParent(station, msg, udpServerSocket, 0)
 
 
-def readTimetable(filepath):
+def readTimetableRecords(filepath):
     """
-    Read the timetable upon startup of the server
+    Read the station coordinates and the timetable records from the timetable file
     """
-    timetable = []
+    timetableRecords = []
     rowCount = 0
     with open(filepath, 'r') as file:
         reader = csv.reader(file, delimiter=',')
@@ -956,43 +3272,235 @@ def readTimetable(filepath):
             if rowCount == 0:
                 stationCoordinates = row
 
-            else:
-                timetable.append(row)
+            elif len(row) >= 5:
+                timetableRecords.append(row)
             rowCount = rowCount+1
 
+    return timetableRecords, stationCoordinates
+
+
+def readTimetable(filepath):
+    """
+    Read the timetable upon startup of the server
+    """
+    timetableRecords, stationCoordinates = readTimetableRecords(filepath)
+    timetable = Timetable()
+    timetable.addRecords(timetableRecords)
     return timetable, stationCoordinates
 
 
-def checkAndUpdateTimetable(station, path, osstat):
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def startInotify(path):
+    """
+    Watch the directory holding the timetable with inotify. Returns the inotify file descriptor or None if inotify is not available.
+    The directory is watched (rather than the file) so timetables replaced by a rename are also picked up.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        inotifyFd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError, TypeError):
+        return None
+    if inotifyFd < 0:
+        return None
+    watchDescriptor = libc.inotify_add_watch(inotifyFd, os.path.dirname(path).encode(),
+                                             IN_CLOSE_WRITE | IN_MOVED_TO)
+    if watchDescriptor < 0:
+        os.close(inotifyFd)
+        return None
+    return inotifyFd
+
+
+class TimetableWatcher:
+    """
+    Watches the station timetable (tt-<station>) and reloads it when it changes.
+    Changes are detected with inotify, or by polling os.stat at most once every pollInterval seconds if inotify is missing.
+    The file is parsed and diffed against the loaded timetable on a worker thread, and the patched Timetable is swapped
+    into the station from the event loop, so a request being serviced always sees a single timetable version.
+    """
+
+    def __init__(self, station, path, pollInterval=TIMETABLE_POLL_INTERVAL):
+        self.station = station
+        self.path = path
+        self.fileName = os.path.basename(path)
+        self.pollInterval = pollInterval
+        self.osstat = os.stat(path)
+        self.nextPoll = ts.monotonic() + pollInterval
+        self.inotifyFd = startInotify(path)
+        self.reloadThread = None
+        self.reloadRequested = False
+        self.reloadResults = queue.SimpleQueue()
+        # the worker thread wakes up the selector through this socket pair once a reload is parsed
+        self.wakeupReader, self.wakeupWriter = socket.socketpair()
+        self.wakeupReader.setblocking(False)
+        self.reloadCount = 0
+        self.lastReloadDuration = 0.0
+        self.totalReloadDuration = 0.0
+
+    def register(self, sel):
+        sel.register(self.wakeupReader, selectors.EVENT_READ, data=self)
+        if self.inotifyFd != None:
+            sel.register(self.inotifyFd, selectors.EVENT_READ, data=self)
+            print(f"Watching {self.path} with inotify.")
+        else:
+            print(
+                f"inotify not available. Polling {self.path} every {self.pollInterval}s.")
+
+    def addToLoop(self, loop):
+        """
+        Watch the timetable from an asyncio event loop instead of a selector
+        """
+        loop.add_reader(self.wakeupReader, self.handleEvent,
+                        self.wakeupReader)
+        if self.inotifyFd != None:
+            loop.add_reader(self.inotifyFd, self.handleEvent, self.inotifyFd)
+            print(f"Watching {self.path} with inotify.")
+        else:
+            print(
+                f"inotify not available. Polling {self.path} every {self.pollInterval}s.")
+
+            def pollTimetable():
+                self.poll()
+                loop.call_later(self.pollInterval, pollTimetable)
+            loop.call_later(self.pollInterval, pollTimetable)
+
+    def getTimeout(self):
+        """
+        Get the longest time the selector can block before the timetable needs polling
+        """
+        if self.inotifyFd != None:
+            return None
+        return max(self.nextPoll - ts.monotonic(), 0)
+
+    def poll(self):
+        """
+        Check the timetable's modification time if inotify is not available and the poll interval has passed
+        """
+        if self.inotifyFd != None or ts.monotonic() < self.nextPoll:
+            return
+        self.nextPoll = ts.monotonic() + self.pollInterval
+        try:
+            osstat = os.stat(self.path)
+        except OSError:
+            return  # the timetable is being replaced, try again on the next poll
+        if osstat.st_mtime != self.osstat.st_mtime or osstat.st_size != self.osstat.st_size:
+            self.osstat = osstat
+            self.startReload()
+
+    def handleEvent(self, fileobj):
+        """
+        Service an inotify event or the wakeup from a finished reload
+        """
+        if fileobj == self.inotifyFd:
+            events = os.read(self.inotifyFd, 4096)
+            offset = 0
+            changed = False
+            while offset < len(events):
+                watchDescriptor, mask, cookie, nameLength = INOTIFY_EVENT.unpack_from(
+                    events, offset)
+                offset = offset + INOTIFY_EVENT.size
+                name = events[offset:offset + nameLength].rstrip(b"\0")
+                offset = offset + nameLength
+                if name.decode(FORMAT, "replace") == self.fileName:
+                    changed = True
+            if changed:
+                self.startReload()
+        else:
+            try:
+                self.wakeupReader.recv(1024)
+            except BlockingIOError:
+                pass
+            self.swapTimetable()
+
+    def startReload(self):
+        if self.reloadThread != None:
+            # a reload is already running, reload again once it has finished
+            self.reloadRequested = True
+            return
+        self.reloadThread = threading.Thread(
+            target=self.reloadTimetable, daemon=True)
+        self.reloadThread.start()
+
+    def reloadTimetable(self):
+        """
+        Parse the timetable and patch the changed destinations on the worker thread
+        """
+        startTime = ts.perf_counter()
+        try:
+            timetableRecords, _ = readTimetableRecords(self.path)
+
+            timetable, changedDestinations = self.station.timetable.patch(
+                timetableRecords)
+        except Exception as exception:
+            timetable = None
+            changedDestinations = None
+            print(f"Failed to reload timetable {self.path}: {exception}")
+        self.reloadResults.put(
+            (timetable, changedDestinations, ts.perf_counter() - startTime))
+        self.wakeupWriter.send(b"\0")
+
+    def swapTimetable(self):
+        """
+        Swap in reloaded timetables on the event loop thread
+        """
+        while not self.reloadResults.empty():
+            timetable, changedDestinations, duration = self.reloadResults.get()
+            self.reloadThread = None
+            if timetable != None:
+                # nothing to swap in if no destination changed
+                if len(changedDestinations) > 0:
+                    self.station.setTimetable(timetable, changedDestinations)
+                self.reloadCount = self.reloadCount + 1
+                self.lastReloadDuration = duration
+                self.totalReloadDuration = self.totalReloadDuration + duration
+                print(
+                    f"Timetable reloaded ({self.reloadCount} reloads, {len(changedDestinations)} destinations changed) in {duration * 1000:.2f}ms. "
+                    f"Average reload time: {self.totalReloadDuration / self.reloadCount * 1000:.2f}ms")
+        if self.reloadRequested and self.reloadThread == None:
+            self.reloadRequested = False
+            self.startReload()
+
+
+def getSelectTimeout(*timeouts):
     """
-    Check if the timetable has been updated. If so, fetch latest. 
+    Get the shortest of the timeouts, ignoring None (no timeout)
     """
-    if osstat.st_mtime != os.stat(path).st_mtime:
-        timetable, stationCoordinates = readTimetable(path)
-        station.setTimetable(timetable)
-        return os.stat(path)
-    return osstat
+    timeouts = [timeout for timeout in timeouts if timeout != None]
+    if len(timeouts) == 0:
+        return None
+    return min(timeouts)
 
 
-def serveTcpUdpPort(station, sel, tcpServerSocket, udpServerSocket, messageSentLogs, clientRequestLogs, messageBank, path, osstat):
+def serveTcpUdpPort(station, sel, tcpServerSocket, udpServerSocket, messageSentLogs, clientRequestLogs, messageBank, timetableWatcher):
     """
     Service both TCP And UDP server
     """
     # wait for connection
     try:
         while True:
-            # wait unitl registered file objects become ready and set a selector with no timeout
+            # wait unitl registered file objects become ready. The selector only has a timeout if the timetable needs polling
+            # or a hop deadline is pending
             # the call will block until file object becomes ready -- either TCP or UDP has an EVENT_READ
-            events = sel.select(timeout=None)
+            events = sel.select(timeout=getSelectTimeout(
+                timetableWatcher.getTimeout(), station.timers.getTimeout()))
+            timetableWatcher.poll()
+            station.timers.runDueTimers()
             for key, mask in events:
-                # check and update timetable each time a new event is triggered
-                osstat = checkAndUpdateTimetable(station, path, osstat)
+                # the timetable has changed or a reloaded timetable is ready
+                if key.data is timetableWatcher:
+                    timetableWatcher.handleEvent(key.fileobj)
+
                 # a listening socket that hasn't been accepted yet i.e. no data
-                if key.data is None:
+                elif key.data is None:
 
                     # if the listening socket is TCP
                     if key.fileobj.getsockname() == station.tcp_address:
-                        acceptTcpWrapper(key.fileobj, sel)
+                        acceptTcpWrapper(key.fileobj, sel, station, clientRequestLogs)
+
 
                     # if the listening socket is UDP
                     if key.fileobj.getsockname() == station.udp_address:
@@ -1002,12 +3510,12 @@ def serveTcpUdpPort(station, sel, tcpServerSocket, udpServerSocket, messageSentL
                 # a client socket that has been accepted and now we need to service it i.e. has data
                 else:
                     try:
-                        if key.fileobj.getsockname() == station.tcp_address:
-                            serviceTcpConnection(
-                                key, mask, sel, station, udpServerSocket, messageSentLogs, clientRequestLogs)
-                    except:
+                        serviceTcpConnection(
+                            key, mask, sel, station, udpServerSocket, messageSentLogs, clientRequestLogs, messageBank)
+                    except Exception:
                         print("TCP Connetion is closed.")
-                        pass
+                        closeTcpConnection(
+                            key.fileobj, sel, key.data, clientRequestLogs)
 
     except KeyboardInterrupt:
         print("Caught keyboard interrupt, exiting")
@@ -1015,6 +3523,169 @@ def serveTcpUdpPort(station, sel, tcpServerSocket, udpServerSocket, messageSentL
         sel.close()
 
 
+class StationDatagramProtocol(asyncio.DatagramProtocol):
+    """
+    Inter-station UDP communication for the asyncio engine. The datagram transport is wrapped in a ReliableUdpTransport
+    and passed to the message handlers in place of the UDP socket.
+    """
+
+    def __init__(self, station, messageSentLogs, clientRequestLogs, messageBank):
+        self.station = station
+        self.messageSentLogs = messageSentLogs
+        self.clientRequestLogs = clientRequestLogs
+        self.messageBank = messageBank
+        self.transport = None
+
+    def connection_made(self, transport):
+        if self.station.udpBufferSize != None:
+            setUdpBufferSize(transport.get_extra_info(
+                "socket"), self.station.udpBufferSize)
+        self.transport = ReliableUdpTransport(self.station, transport)
+
+    def datagram_received(self, datagram, address):
+        serviceUdpMessage(datagram, address, self.station, self.transport,
+                          self.messageSentLogs, self.clientRequestLogs, self.messageBank)
+
+    def error_received(self, exception):
+        print(f"UDP error: {exception}")
+
+
+async def serviceAsyncTcpConnection(reader, writer, station, udpTransport, messageSentLogs, clientRequestLogs, messageBank):
+    """
+    Service a client (browser) connection on the asyncio engine.
+    The coroutine reads each request, starts the query and awaits the response. If the client closes the connection
+    while it is waiting, the query is cancelled and its request log dropped. A keep-alive connection is served until
+    the client closes it or sends no request for KEEP_ALIVE_TIMEOUT seconds.
+    """
+    loop = asyncio.get_running_loop()
+    parser = HttpRequestParser()
+    data = types.SimpleNamespace(addr=writer.get_extra_info("peername"),
+                                 state="reading", keepAlive=False, batchKeys=[])
+    try:
+        while True:
+            responseFuture = loop.create_future()
+
+            def respond(response, responseFuture=responseFuture):
+                if not responseFuture.done():
+                    responseFuture.set_result(response)
+
+            data.respond = respond
+            # the request may arrive over several reads, or already be buffered behind the last one
+            try:
+                request = parser.getRequest()
+                while request == None:
+                    received = await asyncio.wait_for(reader.read(TCP_RECV_SIZE), KEEP_ALIVE_TIMEOUT)
+                    if not received:
+                        return
+                    parser.feed(received)
+                    request = parser.getRequest()
+            except ValueError as exception:
+                print(f"Bad request from {data.addr}: {exception}")
+                writer.write(getHttpErrorResponse(getBadRequestStatus(exception)))
+                await writer.drain()
+                return
+            data.state = "waiting"
+            data.keepAlive = request.keepAlive
+            serviceClientRequest(request, writer, data, station,
+                                 udpTransport, messageSentLogs, clientRequestLogs, messageBank)
+            # wait for the response, the client closing the connection or the timeout, whichever comes first
+            deadline = loop.time() + CLIENT_TIMEOUT
+            while not responseFuture.done():
+                readTask = asyncio.ensure_future(reader.read(TCP_RECV_SIZE))
+                done, pending = await asyncio.wait([responseFuture, readTask], timeout=max(deadline - loop.time(), 0),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if readTask in done:
+                    received = readTask.result()
+                    if not received:
+                        print(f"Client {data.addr} has closed the connection.")
+                        return
+                    # the client has sent its next request already
+                    parser.feed(received)
+                    continue
+                readTask.cancel()
+                if readTask.done() and not readTask.cancelled():
+                    parser.feed(readTask.result())
+                if len(done) == 0:
+                    print(f"Timed out waiting for a route for {data.addr}")
+                    clientRequestLogs.removeConnection(writer, data)
+                    sendResponseToClient(
+                        station, data, [], "true", True, "Oh uh! No route found!")
+            data.state = "writing"
+            writer.write(responseFuture.result())
+            await writer.drain()
+            if not data.keepAlive:
+                return
+            data.state = "reading"
+    except asyncio.TimeoutError:
+        print(f"Keep-alive connection to {data.addr} is idle.")
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError) as exception:
+        print(f"TCP Connetion is closed: {exception}")
+    except RequestTooLarge as exception:
+        # sent ahead of the answer to the last request
+        print(f"Closing the connection to {data.addr}: {exception}")
+    finally:
+        data.state = "closed"
+        clientRequestLogs.removeConnection(writer, data)
+        writer.close()
+
+
+async def serveAsyncio(station, messageSentLogs, clientRequestLogs, messageBank, timetableWatcher):
+    """
+    Service both TCP and UDP servers on an asyncio event loop
+    """
+    loop = asyncio.get_running_loop()
+    # hop deadlines are scheduled straight on the event loop
+    station.timers = loop
+    udpTransport, udpProtocol = await loop.create_datagram_endpoint(
+        lambda: StationDatagramProtocol(
+            station, messageSentLogs, clientRequestLogs, messageBank),
+        local_addr=station.udp_address)
+    print(f"[LISTENING] UDP Server is listening on {station.udp_address}.")
+    sendProbes(station, udpProtocol.transport)
+    if station.topology != None:
+        startGossip(station, udpProtocol.transport)
+    tcpServer = await asyncio.start_server(
+        lambda reader, writer: serviceAsyncTcpConnection(
+            reader, writer, station, udpProtocol.transport, messageSentLogs, clientRequestLogs, messageBank),
+        station.tcp_address[0], station.tcp_address[1])
+    print(f"[LISTENING] TCP Server is listening on {station.tcp_address}.")
+    timetableWatcher.addToLoop(loop)
+    try:
+        async with tcpServer:
+            await tcpServer.serve_forever()
+    finally:
+        udpTransport.close()
+
+
+def runAsyncio(station, messageSentLogs, clientRequestLogs, messageBank, timetableWatcher):
+    """
+    Run the asyncio engine, on uvloop if it is installed
+    """
+    if uvloop != None:
+        print("Using uvloop event loop.")
+        uvloop.install()
+    try:
+        asyncio.run(serveAsyncio(station, messageSentLogs,
+                                 clientRequestLogs, messageBank, timetableWatcher))
+    except KeyboardInterrupt:
+        print("Caught keyboard interrupt, exiting")
+
+
+def getOptions(argv):
+    """
+    Split "--name=value" options from the positional inputs
+    """
+    inputs = []
+    options = {}
+    for arg in argv:
+        if arg.startswith("--"):
+            name, _, value = arg[2:].partition("=")
+            options[name] = value
+        else:
+            inputs.append(arg)
+    return inputs, options
+
+
 def acceptInputs(argv):
     """
     Accept inputs from the CLI
@@ -1039,17 +3710,51 @@ def acceptInputs(argv):
 
 def main(argv):
     # store config and neighbours from inputs
+    argv, options = getOptions(argv)
+    engine = options.get("engine", "selectors")
+    if engine not in ENGINES:
+        print(f"Unknown engine: {engine}. Use one of {ENGINES}.")
+        sys.exit(2)
     station = acceptInputs(argv)
     print(f"Station Name: {station.stationName}")
     print(f"tcp_address: {station.tcp_address}")
     print(f"udp_address: {station.udp_address}")
     print(f"Neighbour station: {station.neighbours}")
+    print(f"Engine: {engine}")
+    if "timeout" in options:
+        station.queryTimeout = float(options["timeout"])
+    print(f"Query timeout: {station.queryTimeout}s")
+    if "udp-buffer" in options:
+        station.udpBufferSize = int(options["udp-buffer"])
+    if "batch" in options:
+        # milliseconds, 0 only batches the messages sent while handling one event
+        station.batchWindow = float(options["batch"]) / 1000
+    if "batch-size" in options:
+        station.batchSize = int(options["batch-size"])
+        # a batch and its envelope must fit in one datagram
+        if not 2 < station.batchSize <= MESSAGE_SIZE - ENVELOPE.size:
+            print(f"Batch size must be between 3 and {MESSAGE_SIZE - ENVELOPE.size} bytes.")
+            sys.exit(2)
+    if options.get("prune") == "off":
+        station.prune = False
+    if options.get("wire") == "json":
+        # never ask neighbours to send the binary format
+        station.capabilities.remove("binary")
+    if "cache" in options:
+        station.routeCache.size = int(options["cache"])
+        station.subRouteCache.size = int(options["cache"])
+    routing = options.get("routing", "flood")
+    if routing not in ROUTING:
+        print(f"Unknown routing: {routing}. Use one of {ROUTING}.")
+        sys.exit(2)
+    if routing == "gossip":
+        station.topology = TopologyDatabase(station)
+        station.capabilities.append("gossip")
+    print(f"Routing: {routing}")
 
     # Read CSV timetable file -- assume that all contents are correct
     path = str(pathlib.Path(__file__).parent.absolute()) + \
         f"/tt-{station.stationName}"
-    osstat = os.stat(path)
-    print(osstat)
     timetable, stationCoordinates = readTimetable(path)
     station.setCoordinates(
         float(stationCoordinates[1]), float(stationCoordinates[2]))  # add coordinates
@@ -1059,19 +3764,31 @@ def main(argv):
     svrTimetable = station.timetable
     for row in svrTimetable:
         print(row)
-    # Create selector
-    sel = selectors.DefaultSelector()
-    # Start TCP port
-    tcpServerSocket = startTcpPort(station, sel)
-    # Start UDP port
-    udpServerSocket = startUdpPort(station, sel)
+    # watch the timetable for changes
+    timetableWatcher = TimetableWatcher(station, path)
     # create new message sent logs object to hold messages sent from the server
     messageSentLogs = MessageSentLogs()
     clientRequestLogs = ClientRequestLogs()
     messageBank = MessageBank()
+    if engine == "asyncio":
+        runAsyncio(station, messageSentLogs, clientRequestLogs,
+                   messageBank, timetableWatcher)
+        return None
+    # Create selector and the heap for hop deadlines
+    sel = selectors.DefaultSelector()
+    station.timers = TimerHeap()
+    # Start TCP port
+    tcpServerSocket = startTcpPort(station, sel)
+    # Start UDP port and the reliability layer over it
+    udpServerSocket = ReliableUdpTransport(
+        station, startUdpPort(station, sel))
+    sendProbes(station, udpServerSocket)
+    if station.topology != None:
+        startGossip(station, udpServerSocket)
+    timetableWatcher.register(sel)
     # Serve TCP and UDP ports
     serveTcpUdpPort(station, sel, tcpServerSocket,
-                    udpServerSocket, messageSentLogs, clientRequestLogs, messageBank, path, osstat)
+                    udpServerSocket, messageSentLogs, clientRequestLogs, messageBank, timetableWatcher)
     # TODO: commenting, separating python files, throwing errors
     # TODO: update readme -- use diagram and screenshots of webpage
 
@@ -0,0 +1,188 @@
+"""
+Start a station for each timetable of a network on localhost, ask every station for a route to every other station
+at 06:30 and 12:00, and check each answer against the arrival a flood of the query over the timetables gives.
+The networks are in tests/networks: net8 and net12 are made like buildrandomtimetables.c does, and the -nonfifo
+ones add slow trips that leave just before a faster one (so a later departure can arrive earlier).
+
+Usage: python tests/floodoracle.py [tests/networks/net8 [station options, e.g. --engine=asyncio --prune=off]]
+Without a network, the runs in CHECKS are made.
+"""
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUERY_TIMES = ["06:30", "12:00"]
+QUERY_TIMEOUT = 20  # seconds to wait for an answer
+NETWORKS = os.path.join(REPOSITORY, "tests", "networks")
+# (network, station options) of the runs made without arguments
+CHECKS = [
+    ("net8", []),
+    ("net8", ["--engine=asyncio"]),
+    ("net12", []),
+    ("net8-nonfifo", ["--cache=0"]),
+    ("net12-nonfifo", ["--cache=0"]),
+    ("net8-nonfifo", ["--routing=gossip", "--cache=0"]),
+    ("net12-nonfifo", ["--routing=gossip", "--cache=0"]),
+]
+
+
+def getMinutes(time):
+    hour, minute = time.split(":")
+    return int(hour) * 60 + int(minute)
+
+
+def readNetwork(path):
+    """
+    Read the adjacency file (each line a station then its neighbours) and the timetable records of each station
+    """
+    neighbours = {}
+    with open(os.path.join(path, "adjacency")) as file:
+        for line in file:
+            names = line.split()
+            neighbours[names[0]] = names[1:]
+    timetables = {}
+    for name in neighbours:
+        with open(os.path.join(path, "tt-" + name)) as file:
+            timetables[name] = [row for row in (line.strip().split(",") for line in file.readlines()[1:])
+                                if len(row) == 5]
+    return neighbours, timetables
+
+
+def flood(timetables, source, destination, arrival, visited=frozenset()):
+    """
+    Get the earliest arrival at the destination the flood of a query finds: each station takes the first trip to each
+    of its destinations, stops if one of them is the query's destination, and never goes back to a station it visited
+    """
+    visited = visited | {source}
+    earliestTrips = {}
+    for departure, line, stop, tripArrival, tripDestination in timetables[source]:
+        if getMinutes(departure) >= arrival and tripDestination not in earliestTrips:
+            earliestTrips[tripDestination] = getMinutes(tripArrival)
+    if destination in earliestTrips:
+        return earliestTrips[destination]
+    best = None
+    for tripDestination, tripArrival in earliestTrips.items():
+        if tripDestination in visited or tripDestination not in timetables:
+            continue
+        found = flood(timetables, tripDestination, destination, tripArrival, visited)
+        if found != None and (best == None or found < best):
+            best = found
+    return best
+
+
+def getFreePort(kind):
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def startStations(path, neighbours, options, workDirectory):
+    """
+    Start a station for each timetable in the work directory, logging to log-<station>.
+    Returns the (tcp port, udp port) of each station and the processes
+    """
+    for fileName in os.listdir(path):
+        shutil.copy(os.path.join(path, fileName), workDirectory)
+    for fileName in ("station.py", "connectionscan.py"):
+        shutil.copy(os.path.join(REPOSITORY, fileName), workDirectory)
+    ports = {}
+    usedPorts = set()
+    for name in neighbours:
+        while True:
+            tcpPort, udpPort = getFreePort(socket.SOCK_STREAM), getFreePort(socket.SOCK_DGRAM)
+            if tcpPort != udpPort and tcpPort not in usedPorts and udpPort not in usedPorts:
+                break
+        usedPorts |= {tcpPort, udpPort}
+        ports[name] = (tcpPort, udpPort)
+    processes = []
+    for name in neighbours:
+        arguments = [sys.executable, "-u", os.path.join(workDirectory, "station.py"), name, str(ports[name][0]),
+                     str(ports[name][1])] + [str(ports[neighbour][1]) for neighbour in neighbours[name]] + options
+        log = open(os.path.join(workDirectory, "log-" + name), "w")
+        processes.append(subprocess.Popen(arguments, stdout=log, stderr=subprocess.STDOUT, cwd=workDirectory))
+    # wait for every station to listen
+    deadline = time.time() + 15
+    for name in neighbours:
+        while time.time() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", ports[name][0]), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+    return ports, processes
+
+
+def query(port, destination, time):
+    """
+    Ask the station for a route. Returns the arrival in minutes, None if no route was found, or the error
+    """
+    url = f"http://127.0.0.1:{port}/?to={destination}&time={time}"
+    try:
+        with urllib.request.urlopen(url, timeout=QUERY_TIMEOUT) as response:
+            body = response.read().decode()
+    except OSError as exception:
+        return repr(exception)
+    arrival = re.search(r"eventually arrive at \S+ at (\d\d:\d\d)", body)
+    if arrival != None:
+        return getMinutes(arrival.group(1))
+    if "No route found" in body:
+        return None
+    return "unknown answer"
+
+
+def checkNetwork(path, options):
+    """
+    Ask every station of the network for a route to every other station. Returns the number of queries and of
+    answers that differ from the flood
+    """
+    neighbours, timetables = readNetwork(path)
+    workDirectory = tempfile.mkdtemp(prefix="floodoracle-")
+    ports, processes = startStations(path, neighbours, options, workDirectory)
+    queries = 0
+    mismatches = 0
+    started = time.time()
+    try:
+        for source in neighbours:
+            for destination in neighbours:
+                if source == destination:
+                    continue
+                for queryTime in QUERY_TIMES:
+                    answer = query(ports[source][0], destination, queryTime)
+                    expected = flood(timetables, source, destination, getMinutes(queryTime))
+                    queries += 1
+                    if answer != expected:
+                        mismatches += 1
+                        print(f"MISMATCH {source} -> {destination} at {queryTime}: {answer}, expected {expected}")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+    print(f"{' '.join([os.path.basename(path)] + options)}: {queries} queries, {mismatches} mismatches, "
+          f"{time.time() - started:.2f}s (logs in {workDirectory})")
+    return queries, mismatches
+
+
+def main(argv):
+    if len(argv) > 0 and argv[0] in ("-h", "--help"):
+        print(__doc__)
+        sys.exit(2)
+    if len(argv) > 0:
+        checks = [(argv[0], argv[1:])]
+    else:
+        checks = [(os.path.join(NETWORKS, network), options) for network, options in CHECKS]
+    mismatches = 0
+    for path, options in checks:
+        mismatches += checkNetwork(path, options)[1]
+    sys.exit(1 if mismatches > 0 else 0)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
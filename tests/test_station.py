@@ -0,0 +1,266 @@
+"""
+Unit tests for station.py.
+Run from the repository root with: python -m unittest discover tests
+"""
+import json
+import os
+import sys
+import unittest
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import station  # noqa: E402
+
+
+def getMessage(messageType="outgoing", **fields):
+    """
+    Get a message as a station would send it on its second hop
+    """
+    msg = {
+        "sourceName": "BusportA",
+        "destinationName": "JunctionB",
+        "route": [
+            {"stationName": "BusportA", "messageId": uuid.uuid1().int, "stationUDPAddress": "http://127.0.0.1:4001",
+             "earliestTrips": [["08:00", "bus1", "stop1", "08:30", "StationC"],
+                               ["08:05", "bus2", "stop2", "08:50", "JunctionD"]],
+             "timetableVersion": "3"},
+            {"stationName": "StationC", "messageId": "java-message-id", "stationUDPAddress": "http://127.0.0.1:4002",
+             "earliestTrips": []}
+        ],
+        "tripType": "FastestTrip",
+        "hopCount": 1,
+        "time": "08:00",
+        "messageId": uuid.uuid1().int,
+        "messageType": messageType,
+        "routeEndFound": False,
+        "queryTimeout": 9.8,
+        "capabilities": list(station.CAPABILITIES)
+    }
+    msg.update(fields)
+    return msg
+
+
+class BinaryMessageTest(unittest.TestCase):
+
+    def assertRoundTrip(self, msg):
+        data = station.encodeBinaryMessage(msg)
+        self.assertTrue(data.startswith(station.BINARY_MAGIC))
+        # the binary format decodes to what the JSON one would
+        self.assertEqual(station.decodeMessage(data), json.loads(json.dumps(msg)))
+
+    def test_round_trip(self):
+        self.assertRoundTrip(getMessage())
+        self.assertRoundTrip(getMessage("incoming", routeEndFound=True, incomplete=1))
+        self.assertRoundTrip(getMessage(queryTimeout=None, capabilities=[]))
+        self.assertRoundTrip(getMessage(destinationName="Gare Saint-Lazare é", route=[], hopCount=0))
+
+    def test_round_trip_without_timetable_versions(self):
+        msg = getMessage()
+        del msg["route"][0]["timetableVersion"]
+        self.assertRoundTrip(msg)
+
+    def test_truncated_message(self):
+        messages = [getMessage(), getMessage("incoming", incomplete=2), getMessage(queryTimeout=None)]
+        # a message whose last field is a messageId of either type
+        for messageId in (uuid.uuid1().int, "java-message-id"):
+            msg = getMessage(queryTimeout=None)
+            msg["route"] = msg["route"][:1]
+            msg["route"][0]["messageId"] = messageId
+            del msg["route"][0]["timetableVersion"]
+            messages.append(msg)
+        for msg in messages:
+            data = station.encodeBinaryMessage(msg)
+            for length in range(len(data)):
+                with self.assertRaises(ValueError, msg=f"{length} of {len(data)} bytes"):
+                    station.decodeMessage(data[:length])
+
+    def test_unknown_version(self):
+        data = bytearray(station.encodeBinaryMessage(getMessage()))
+        data[len(station.BINARY_MAGIC)] = station.BINARY_VERSION + 1
+        with self.assertRaises(ValueError):
+            station.decodeMessage(bytes(data))
+
+    def test_falls_back_to_json(self):
+        msg = getMessage(unknownField=True)
+        data = station.encodeMessage(msg, "binary")
+        self.assertEqual(json.loads(data), json.loads(json.dumps(msg)))
+
+
+class HttpRequestParserTest(unittest.TestCase):
+
+    def test_request_split_over_reads(self):
+        parser = station.HttpRequestParser()
+        request = b"GET /?to=JunctionB&time=08%3A00 HTTP/1.1\r\nHost: localhost\r\n\r\n"
+        for index in range(len(request)):
+            self.assertIsNone(parser.getRequest())
+            parser.feed(request[index:index + 1])
+        request = parser.getRequest()
+        self.assertEqual(request.method, "GET")
+        self.assertEqual(request.path, "/")
+        self.assertEqual(request.query, "to=JunctionB&time=08%3A00")
+        self.assertEqual(request.headers, {"host": "localhost"})
+        self.assertTrue(request.keepAlive)
+        self.assertEqual(len(parser.buffer), 0)
+
+    def test_pipelined_requests(self):
+        parser = station.HttpRequestParser()
+        body = b'[{"to": "JunctionB"}]'
+        parser.feed(b"POST /api/routes HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % len(body) + body +
+                    b"GET / HTTP/1.0\n\n")
+        request = parser.getRequest()
+        self.assertEqual((request.method, request.path, request.body), ("POST", "/api/routes", body))
+        request = parser.getRequest()
+        self.assertEqual((request.method, request.version), ("GET", "HTTP/1.0"))
+        self.assertFalse(request.keepAlive)
+        self.assertIsNone(parser.getRequest())
+
+    def test_body_waits_for_content_length(self):
+        parser = station.HttpRequestParser()
+        parser.feed(b"POST /api/routes HTTP/1.1\r\nContent-Length: 4\r\n\r\n[]")
+        self.assertIsNone(parser.getRequest())
+        parser.feed(b"  ")
+        self.assertEqual(parser.getRequest().body, b"[]  ")
+
+    def test_malformed_requests(self):
+        for data in [b"GARBAGE\r\n\r\n", b"GET / HTTP/2\r\n\r\n", b"GET / HTTP/1.1\r\nno colon\r\n\r\n",
+                     b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n",
+                     b"POST / HTTP/1.1\r\nContent-Length: -1\r\n\r\n", b"X" * (station.MAX_HEADER_SIZE + 1)]:
+            parser = station.HttpRequestParser()
+            parser.feed(data)
+            with self.assertRaises(ValueError) as context:
+                parser.getRequest()
+            self.assertEqual(station.getBadRequestStatus(context.exception), "400 Bad Request")
+
+    def test_body_too_large(self):
+        parser = station.HttpRequestParser()
+        parser.feed(b"POST /api/routes HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % (station.MAX_BODY_SIZE + 1))
+        with self.assertRaises(station.RequestTooLarge) as context:
+            parser.getRequest()
+        self.assertEqual(station.getBadRequestStatus(context.exception), "413 Payload Too Large")
+
+    def test_buffer_is_capped(self):
+        parser = station.HttpRequestParser()
+        parser.feed(b"X" * station.MAX_BUFFER_SIZE)
+        with self.assertRaises(station.RequestTooLarge):
+            parser.feed(b"X")
+
+    def test_accept_encoding(self):
+        for acceptEncoding, acceptsGzip in [("gzip, deflate", True), ("deflate, gzip;q=0.5", True), ("*", True),
+                                            ("gzip;q=0", False), ("gzip; q=0.0, deflate", False),
+                                            ("*, gzip;q=0", False), ("deflate", False), ("", False)]:
+            request = station.HttpRequest("GET", "/api/route", "HTTP/1.1", {"accept-encoding": acceptEncoding}, b"")
+            self.assertEqual(request.acceptsEncoding("gzip"), acceptsGzip, acceptEncoding)
+
+
+class RequestObjectTest(unittest.TestCase):
+
+    def test_time(self):
+        for time in ["08:00", "8:00", "0:00", "23:59", ""]:
+            station.checkRequestObject([{"to": "JunctionB"}, {"time": time}])
+        for time in ["abc", "6", "630", "24:00", "08:60", "08:0", "-1:00", "08:00:00", "０８:００"]:
+            with self.assertRaises(ValueError, msg=time):
+                station.checkRequestObject([{"to": "JunctionB"}, {"time": time}])
+
+    def test_trip_type(self):
+        for tripType in station.TRIP_TYPE + [""]:
+            station.checkRequestObject([{"to": "JunctionB"}, {"tripType": tripType}])
+        for tripType in ["Bogus", "fastesttrip"]:
+            with self.assertRaises(ValueError, msg=tripType):
+                station.checkRequestObject([{"to": "JunctionB"}, {"tripType": tripType}])
+
+    def test_batch_is_checked_before_it_starts(self):
+        request = station.HttpRequest("POST", "/api/routes", "HTTP/1.1", {},
+                                      b'[{"to": "JunctionB", "time": "08:00"}, {"to": "StationC", "time": 630}]')
+        with self.assertRaises(ValueError):
+            station.getBatchRequestObjects(request)
+
+
+class TimetablePatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.records = [["08:00", "bus1", "stop1", "08:30", "StationC"],
+                        ["09:00", "bus1", "stop1", "09:30", "StationC"],
+                        ["08:10", "bus2", "stop2", "08:50", "JunctionD"],
+                        ["08:20", "bus3", "stop3", "09:10", "TerminalE"]]
+        self.timetable = station.Timetable()
+        self.timetable.addRecords(self.records)
+
+    def getBucket(self, timetable, destinationName):
+        return timetable.buckets[timetable.nameIds[destinationName]]
+
+    def test_unchanged_timetable(self):
+        timetable, changedDestinations = self.timetable.patch(list(reversed(self.records)))
+        self.assertEqual(changedDestinations, set())
+        for destinationName in ("StationC", "JunctionD", "TerminalE"):
+            self.assertIs(self.getBucket(timetable, destinationName),
+                          self.getBucket(self.timetable, destinationName))
+
+    def test_changed_destinations(self):
+        records = [self.records[0], ["09:05", "bus1", "stop1", "09:35", "StationC"], self.records[2],
+                   ["10:00", "bus4", "stop4", "10:20", "BusportF"]]
+        timetable, changedDestinations = self.timetable.patch(records)
+        self.assertEqual(changedDestinations, {"StationC", "TerminalE", "BusportF"})
+        self.assertIs(self.getBucket(timetable, "JunctionD"), self.getBucket(self.timetable, "JunctionD"))
+        self.assertNotIn(self.timetable.nameIds["TerminalE"], timetable.buckets)
+        self.assertEqual(timetable.getRecords(), sorted(records))
+        self.assertEqual(timetable.getEarliestTrip("08:30", "StationC"), records[1])
+        # the old version is left as it was
+        self.assertEqual(self.timetable.getRecords(), sorted(self.records))
+
+
+class RouteCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.records = [["08:00", "bus1", "stop1", "08:30", "StationC"],
+                        ["09:00", "bus1", "stop1", "09:30", "StationC"],
+                        ["08:10", "bus2", "stop2", "08:50", "JunctionD"]]
+        self.station = station.Station("BusportA", 4000, 4001)
+        timetable = station.Timetable()
+        timetable.addRecords(self.records)
+        self.station.setTimetable(timetable)
+
+    def addAnswer(self, time):
+        route = [{"stationName": "BusportA", "timetableVersion": self.station.getTimetableStamp()}]
+        self.station.routeCache.add({"destinationName": "StationC", "tripType": "FastestTrip", "time": time,
+                                     "route": route})
+
+    def getAnswer(self, time):
+        return self.station.routeCache.get({"destinationName": "StationC", "tripType": "FastestTrip", "time": time,
+                                            "messageId": 1})
+
+    def patch(self, records):
+        self.station.setTimetable(*self.station.timetable.patch(records))
+
+    def test_unrelated_change_keeps_answers(self):
+        self.addAnswer("07:00")
+        self.addAnswer("08:30")
+        # a later trip to StationC leaves the earliest trips of both windows as they were
+        self.patch(self.records + [["09:30", "bus1", "stop1", "10:00", "StationC"]])
+        for time in ("07:00", "08:30"):
+            answer = self.getAnswer(time)
+            self.assertIsNotNone(answer, time)
+            self.assertEqual(answer["route"][0]["timetableVersion"], self.station.getTimetableStamp())
+
+    def test_changed_earliest_trip_drops_answers(self):
+        self.addAnswer("07:00")
+        self.addAnswer("08:30")
+        # a faster trip to StationC than the 09:00 one, so only the 08:30 answer changes
+        self.patch(self.records + [["08:40", "bus3", "stop3", "09:00", "StationC"]])
+        self.assertIsNotNone(self.getAnswer("07:00"))
+        self.assertIsNone(self.getAnswer("08:30"))
+        # a new destination is a new earliest trip for both
+        self.patch(self.records + [["08:40", "bus3", "stop3", "09:00", "StationC"],
+                                   ["10:00", "bus4", "stop4", "10:20", "TerminalE"]])
+        self.assertIsNone(self.getAnswer("07:00"))
+
+    def test_reload_of_everything_drops_answers(self):
+        self.addAnswer("07:00")
+        timetable = station.Timetable()
+        timetable.addRecords(self.records)
+        self.station.setTimetable(timetable)
+        self.assertIsNone(self.getAnswer("07:00"))
+
+
+if __name__ == "__main__":
+    unittest.main()